@@ -1,5 +1,17 @@
 from django import forms
 
+from hamlet import export_files
+from .models import WorkflowExport
+
+
+def output_format_choices():
+    """Return the output formats that can be exported with what's installed."""
+    return [
+        (output_format, label)
+        for output_format, label in WorkflowExport.OUTPUT_FORMAT_CHOICES
+        if output_format != WorkflowExport.PARQUET or export_files.parquet_available()
+    ]
+
 
 class WorkflowExportForm(forms.Form):
     storage_prefix = forms.CharField(
@@ -7,3 +19,8 @@ class WorkflowExportForm(forms.Form):
         max_length=256,
         widget=forms.TextInput(attrs={'placeholder': 'gs://my-storage-bucket'}),
     )
+    output_format = forms.ChoiceField(
+        label='Output format',
+        choices=output_format_choices,
+        initial=WorkflowExport.CSV,
+    )
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exports', '0009_kadesubjectassistantexport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaMetadataCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(unique=True)),
+                ('hash', models.CharField(max_length=32)),
+                ('filesize', models.IntegerField()),
+                ('etag', models.CharField(max_length=256, null=True)),
+                ('last_modified', models.CharField(max_length=64, null=True)),
+                ('validated', models.DateTimeField()),
+                ('last_used', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_used', 'id'], name='exports_med_last_us_756dcc_idx')],
+            },
+        ),
+    ]
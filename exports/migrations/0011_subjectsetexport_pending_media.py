@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exports', '0010_mediametadatacache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subjectsetexport',
+            name='pending_media',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exports', '0011_subjectsetexport_pending_media'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subjectsetexport',
+            name='last_frame_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='subjectsetexport',
+            name='last_subject_id',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exports', '0012_subjectsetexport_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mediametadata',
+            name='filesize',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='mediametadatacache',
+            name='filesize',
+            field=models.BigIntegerField(),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exports', '0013_big_filesizes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mediametadata',
+            name='subject_id',
+            field=models.IntegerField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exports', '0014_mediametadata_subject_id_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='kadesubjectassistantexport',
+            index=models.Index(fields=['subject_set_id', 'created'], name='exports_kad_subject_257e14_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mediametadata',
+            index=models.Index(fields=['export', 'status'], name='exports_med_export__a77d82_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mediametadata',
+            index=models.Index(fields=['export', 'url'], name='exports_med_export__7768d1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mlsubjectassistantexport',
+            index=models.Index(fields=['subject_set_id', 'created'], name='exports_mls_subject_dac692_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subjectsetexport',
+            index=models.Index(fields=['subject_set_id', 'created'], name='exports_sub_subject_7e916f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='workflowexport',
+            index=models.Index(fields=['workflow_id', 'created'], name='exports_wor_workflo_9f681c_idx'),
+        ),
+    ]
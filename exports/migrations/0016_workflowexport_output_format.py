@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exports', '0015_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflowexport',
+            name='output_format',
+            field=models.CharField(choices=[('csv', 'CSV'), ('csv.gz', 'Gzipped CSV'), ('parquet', 'Parquet')], default='csv', max_length=8),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exports', '0016_workflowexport_output_format'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManifestBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_name', models.CharField(max_length=64)),
+                ('container_name', models.CharField(max_length=64)),
+                ('blob_name', models.CharField(max_length=1024)),
+                ('sha256', models.CharField(max_length=64)),
+                ('size', models.BigIntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('account_name', 'container_name', 'sha256')},
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exports', '0017_manifestblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subjectsetexport',
+            name='snapshot_generation',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.CreateModel(
+            name='SubjectSetSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject_set_id', models.IntegerField(unique=True)),
+                ('generation', models.IntegerField(default=0)),
+                ('project_id', models.IntegerField(null=True)),
+                ('refreshed', models.DateTimeField(null=True)),
+                ('subject_count', models.IntegerField(default=0)),
+                ('location_count', models.IntegerField(default=0)),
+                ('refresh_token', models.UUIDField(null=True)),
+                ('refresh_heartbeat', models.DateTimeField(null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SubjectSetSnapshotLocation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject_id', models.IntegerField()),
+                ('frame_id', models.IntegerField()),
+                ('url', models.URLField()),
+                ('added_generation', models.IntegerField()),
+                ('removed_generation', models.IntegerField(null=True)),
+                ('snapshot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='locations', to='exports.SubjectSetSnapshot')),
+            ],
+            options={
+                'unique_together': {('snapshot', 'subject_id', 'frame_id', 'added_generation')},
+            },
+        ),
+    ]
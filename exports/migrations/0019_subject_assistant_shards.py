@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:58
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('exports', '0018_subjectsetsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kadesubjectassistantexport',
+            name='shard_azure_urls',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=512), default=list, size=None),
+        ),
+        migrations.AddField(
+            model_name='kadesubjectassistantexport',
+            name='shard_service_job_urls',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.URLField(null=True), default=list, size=None),
+        ),
+        migrations.AddField(
+            model_name='mlsubjectassistantexport',
+            name='shard_azure_urls',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=512), default=list, size=None),
+        ),
+        migrations.AddField(
+            model_name='mlsubjectassistantexport',
+            name='shard_ml_task_uuids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.UUIDField(null=True), default=list, size=None),
+        ),
+    ]
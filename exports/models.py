@@ -1,5 +1,11 @@
+from datetime import timedelta
+
 from celery.result import AsyncResult
-from django.db import models
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 
 
 class StatusModel(models.Model):
@@ -43,28 +49,213 @@ class StatusModel(models.Model):
 class SubjectSetExport(StatusModel):
     subject_set_id = models.IntegerField()
     csv = models.FileField(upload_to='subject_sets/', null=True)
+    # number of media files still to be fetched, plus one for the subject
+    # set enumeration while it is still running
+    pending_media = models.IntegerField(default=0)
+    # the (subject_id, frame_id) of the last subject set snapshot location
+    # whose MediaMetadata have been saved, and the snapshot generation being
+    # read, if it's read in order
+    last_subject_id = models.IntegerField(null=True)
+    last_frame_id = models.IntegerField(null=True)
+    snapshot_generation = models.IntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['subject_set_id', 'created']),
+        ]
+
+    @property
+    def resumable(self):
+        """Whether the export has failed, or stopped making progress.
+
+        Running exports are only resumable once nothing has happened to
+        them for SUBJECT_SET_EXPORT_STALE_AFTER seconds, so that a healthy
+        export's tasks aren't still counting down its pending media.
+        """
+        if self.status == self.FAILED:
+            return True
+        return (
+            self.status == self.RUNNING and
+            self.modified < timezone.now() - timedelta(
+                seconds=settings.SUBJECT_SET_EXPORT_STALE_AFTER,
+            )
+        )
+
+    def add_pending_media(self, count):
+        SubjectSetExport.objects.filter(pk=self.pk).update(
+            pending_media=F('pending_media') + count,
+            modified=timezone.now(),
+        )
+
+    def finish_pending_media(self, count):
+        """Record that `count` pending items have finished.
+
+        Returns True for exactly one caller: the one that finishes the last
+        pending item.
+        """
+        if not count:
+            return False
+        with transaction.atomic():
+            export = SubjectSetExport.objects.select_for_update().get(pk=self.pk)
+            export.pending_media -= count
+            export.save(update_fields=['pending_media', 'modified'])
+        return export.pending_media == 0
 
 
 class MediaMetadata(StatusModel):
     export = models.ForeignKey(SubjectSetExport, on_delete=models.CASCADE)
-    subject_id = models.IntegerField()
+    subject_id = models.IntegerField(db_index=True)
     hash = models.CharField(max_length=32, null=True)
-    filesize = models.IntegerField(null=True)
+    filesize = models.BigIntegerField(null=True)
     url = models.URLField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['export', 'status']),
+            models.Index(fields=['export', 'url']),
+        ]
+
+
+class MediaMetadataCache(models.Model):
+    """Filesize and hash of a media URL, shared between exports."""
+    url = models.URLField(unique=True)
+    hash = models.CharField(max_length=32)
+    filesize = models.BigIntegerField()
+    etag = models.CharField(max_length=256, null=True)
+    last_modified = models.CharField(max_length=64, null=True)
+    # when the metadata was last fetched or revalidated against the media host
+    validated = models.DateTimeField()
+    # when an export last used the entry, for least recently used eviction
+    last_used = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_used', 'id']),
+        ]
+
 
 class WorkflowExport(StatusModel):
+    CSV = 'csv'
+    CSV_GZ = 'csv.gz'
+    PARQUET = 'parquet'
+
+    OUTPUT_FORMATS = {
+        CSV: 'CSV',
+        CSV_GZ: 'Gzipped CSV',
+        PARQUET: 'Parquet',
+    }
+
+    OUTPUT_FORMAT_CHOICES = list(OUTPUT_FORMATS.items())
+
     workflow_id = models.IntegerField()
+    # holds the export file in whichever output format was chosen
     csv = models.FileField(upload_to='workflows/', null=True)
+    output_format = models.CharField(
+        max_length=8,
+        choices=OUTPUT_FORMAT_CHOICES,
+        default=CSV,
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['workflow_id', 'created']),
+        ]
+
 
 class MLSubjectAssistantExport(StatusModel):
     subject_set_id = models.IntegerField()
     json = models.FileField(upload_to='ml_subject_assistant/', null=True)
     azure_url = models.CharField(max_length=512, null=True)
     ml_task_uuid = models.UUIDField(null=True)
+    # every shard of a sharded manifest, including the first one in the
+    # fields above, and its ML task (None until it has been submitted)
+    shard_azure_urls = ArrayField(models.CharField(max_length=512), default=list)
+    shard_ml_task_uuids = ArrayField(models.UUIDField(null=True), default=list)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['subject_set_id', 'created']),
+        ]
+
+    @property
+    def shard_count(self):
+        return len(self.shard_ml_task_uuids)
 
 
 class KadeSubjectAssistantExport(StatusModel):
     subject_set_id = models.IntegerField()
     azure_url = models.CharField(max_length=512, null=True)
     service_job_url = models.URLField(max_length=200, null=True)
+    # every shard of a sharded manifest, including the first one in the
+    # fields above, and its prediction job (None until it has been submitted)
+    shard_azure_urls = ArrayField(models.CharField(max_length=512), default=list)
+    shard_service_job_urls = ArrayField(models.URLField(max_length=200, null=True), default=list)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['subject_set_id', 'created']),
+        ]
+
+    @property
+    def shard_count(self):
+        return len(self.shard_service_job_urls)
+
+
+class ManifestBlob(models.Model):
+    """An Azure blob holding a subject manifest, indexed by its content."""
+    account_name = models.CharField(max_length=64)
+    container_name = models.CharField(max_length=64)
+    blob_name = models.CharField(max_length=1024)
+    # hex SHA-256 of the blob's content
+    sha256 = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [['account_name', 'container_name', 'sha256']]
+
+
+class SubjectSetSnapshot(models.Model):
+    """The subject locations of a Subject Set, as last enumerated from Panoptes.
+
+    Shared by every type of export, so that a subject set is only enumerated
+    once for all of them while the snapshot is fresh. Each refresh writes a
+    new generation of the snapshot page by page, and readers keep reading
+    the last complete generation until it's finished.
+    """
+    subject_set_id = models.IntegerField(unique=True)
+    # the last complete generation, 0 until the first refresh has finished
+    generation = models.IntegerField(default=0)
+    # these describe the last complete generation
+    project_id = models.IntegerField(null=True)
+    # when the snapshot was last brought up to date with Panoptes
+    refreshed = models.DateTimeField(null=True)
+    subject_count = models.IntegerField(default=0)
+    location_count = models.IntegerField(default=0)
+    # the refresh writing the next generation, and when it last made progress
+    refresh_token = models.UUIDField(null=True)
+    refresh_heartbeat = models.DateTimeField(null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+
+class SubjectSetSnapshotLocation(models.Model):
+    """A location as of a range of generations of a snapshot.
+
+    A location is part of generation G if it was added in G or earlier, and
+    hasn't been removed as of G.
+    """
+    snapshot = models.ForeignKey(
+        SubjectSetSnapshot,
+        on_delete=models.CASCADE,
+        related_name='locations',
+    )
+    subject_id = models.IntegerField()
+    # the index of the location in the subject's list of locations
+    frame_id = models.IntegerField()
+    url = models.URLField()
+    added_generation = models.IntegerField()
+    removed_generation = models.IntegerField(null=True)
+
+    class Meta:
+        unique_together = [['snapshot', 'subject_id', 'frame_id', 'added_generation']]
@@ -1,3 +1,262 @@
+import uuid
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+from celery.exceptions import Retry
+from django.conf import settings
+from django.db import connection
 from django.test import TestCase
+from django.utils import timezone
+
+from hamlet import celery as hamlet_celery
+from hamlet import panoptes_subjects, subject_snapshots
+from hamlet.media_fetch import MediaInfo
+from .models import SubjectSetExport, MediaMetadata, MediaMetadataCache, WorkflowExport, MLSubjectAssistantExport, KadeSubjectAssistantExport, SubjectSetSnapshot
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Query plans are PostgreSQL specific')
+class HotQueryIndexTests(TestCase):
+    """The queries made by the views and tasks on large tables use an index.
+
+    The tables are empty in tests, so sequential scans are disabled to see
+    whether the planner is able to use an index at all.
+    """
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset):
+        plan = queryset.explain()
+        self.assertNotIn('Seq Scan', plan)
+        self.assertIn('Index', plan)
+
+    def test_latest_subject_set_exports(self):
+        for model in (
+            SubjectSetExport,
+            MLSubjectAssistantExport,
+            KadeSubjectAssistantExport,
+        ):
+            with self.subTest(model=model.__name__):
+                self.assertUsesIndex(
+                    model.objects.filter(subject_set_id=1).order_by('-created')
+                )
+
+    def test_previous_complete_subject_set_export(self):
+        self.assertUsesIndex(
+            SubjectSetExport.objects.filter(
+                subject_set_id=1,
+                status=SubjectSetExport.COMPLETE,
+                created__lt=timezone.now(),
+            ).order_by('-created')
+        )
+
+    def test_latest_workflow_exports(self):
+        self.assertUsesIndex(
+            WorkflowExport.objects.filter(workflow_id=1).order_by('-created')
+        )
+
+    def test_media_metadata_by_status(self):
+        self.assertUsesIndex(
+            MediaMetadata.objects.filter(
+                export_id=1,
+                status=MediaMetadata.FAILED,
+            )
+        )
+
+    def test_media_metadata_by_url(self):
+        self.assertUsesIndex(
+            MediaMetadata.objects.filter(
+                export_id=1,
+                url__in=['https://example.org/1.jpg'],
+            )
+        )
+
+    def test_media_metadata_by_subject(self):
+        self.assertUsesIndex(
+            MediaMetadata.objects.filter(subject_id=1)
+        )
+
+    def test_media_metadata_cache_eviction(self):
+        now = timezone.now()
+        self.assertUsesIndex(
+            MediaMetadataCache.objects.filter(
+                last_used__lte=now,
+            ).exclude(
+                last_used=now,
+                id__gt=1,
+            ).order_by('last_used', 'id')[:100]
+        )
+
+
+def panoptes_subject(subject_id, *urls):
+    return {
+        'id': str(subject_id),
+        'locations': [{'image/jpeg': url} for url in urls],
+    }
+
+
+class SubjectSetSnapshotTests(TestCase):
+    """Refreshes write new generations without disturbing their readers."""
+
+    def setUp(self):
+        self.snapshot = SubjectSetSnapshot.objects.create(subject_set_id=1)
+        self.subject_set = mock.Mock()
+        self.subject_set.links.project.id = '2'
+
+    def refresh(self, pages, token=None, on_page=None):
+        token = token or uuid.uuid4()
+        self.snapshot.refresh_from_db()
+        self.assertTrue(subject_snapshots.claim_refresh(self.snapshot, token))
+        self.snapshot.refresh_from_db()
+        with mock.patch.object(
+            panoptes_subjects,
+            'iter_subject_pages',
+            return_value=iter(pages),
+        ):
+            subject_snapshots.refresh_snapshot(
+                mock.Mock(),
+                self.snapshot,
+                self.subject_set,
+                token,
+                on_page=on_page,
+            )
+
+    def read(self, snapshot):
+        return list(subject_snapshots.iter_snapshot_locations(snapshot))
+
+    def test_pinned_reader_outlives_one_refresh(self):
+        self.refresh([[panoptes_subject(1, 'a'), panoptes_subject(2, 'b')]])
+        pinned = subject_snapshots.pinned_snapshot(1, 1)
+
+        # generation 2 changes a location and removes a subject
+        self.refresh([[panoptes_subject(1, 'c')]])
+        self.assertEqual(self.read(pinned), [(1, 0, 'a'), (2, 0, 'b')])
+        self.assertEqual(self.read(self.snapshot), [(1, 0, 'c')])
+
+        # generation 3 garbage collects what generation 2 removed
+        self.refresh([[panoptes_subject(1, 'c'), panoptes_subject(3, 'd')]])
+        self.assertIsNone(subject_snapshots.pinned_snapshot(1, 1))
+        with self.assertRaises(subject_snapshots.SnapshotGenerationExpired):
+            self.read(pinned)
+        self.assertEqual(
+            self.read(subject_snapshots.pinned_snapshot(1, 2)),
+            [(1, 0, 'c')],
+        )
+        self.assertEqual(self.read(self.snapshot), [(1, 0, 'c'), (3, 0, 'd')])
+
+    def test_refresh_taken_over_partway_is_resumed(self):
+        self.refresh([[panoptes_subject(1, 'a'), panoptes_subject(2, 'b')]])
+        pages = [
+            [panoptes_subject(1, 'a2'), panoptes_subject(2, 'b')],
+            [panoptes_subject(3, 'c')],
+        ]
+        takeover_token = uuid.uuid4()
+
+        def take_over(locations):
+            # the first refresh stalls after its first page
+            SubjectSetSnapshot.objects.filter(pk=self.snapshot.pk).update(
+                refresh_heartbeat=timezone.now() - timedelta(
+                    seconds=settings.SUBJECT_SET_SNAPSHOT_REFRESH_TIMEOUT + 1,
+                ),
+            )
+            self.assertTrue(subject_snapshots.claim_refresh(
+                SubjectSetSnapshot.objects.get(pk=self.snapshot.pk),
+                takeover_token,
+            ))
+
+        with self.assertRaises(subject_snapshots.SnapshotRefreshLost):
+            self.refresh(pages, on_page=take_over)
+        # nothing of the unfinished generation is visible
+        self.snapshot.refresh_from_db()
+        self.assertEqual(self.snapshot.generation, 1)
+        self.assertEqual(self.read(self.snapshot), [(1, 0, 'a'), (2, 0, 'b')])
+
+        # the new claimant rewrites the same generation, with a change since
+        pages[0][0] = panoptes_subject(1, 'a3')
+        with mock.patch.object(
+            panoptes_subjects,
+            'iter_subject_pages',
+            return_value=iter(pages),
+        ):
+            subject_snapshots.refresh_snapshot(
+                mock.Mock(),
+                self.snapshot,
+                self.subject_set,
+                takeover_token,
+            )
+        self.snapshot.refresh_from_db()
+        self.assertEqual(self.snapshot.generation, 2)
+        self.assertIsNone(self.snapshot.refresh_token)
+        self.assertEqual(self.snapshot.subject_count, 3)
+        self.assertEqual(
+            self.read(self.snapshot),
+            [(1, 0, 'a3'), (2, 0, 'b'), (3, 0, 'c')],
+        )
+        self.assertEqual(
+            self.read(subject_snapshots.pinned_snapshot(1, 1)),
+            [(1, 0, 'a'), (2, 0, 'b')],
+        )
+
+
+class PendingMediaTests(TestCase):
+    """A subject set export is finished once, by its last media batch."""
+
+    def setUp(self):
+        self.export = SubjectSetExport.objects.create(
+            subject_set_id=1,
+            status=SubjectSetExport.RUNNING,
+            pending_media=3,
+        )
+        self.task = mock.Mock()
+        self.task.request.id = uuid.uuid4()
+        self.task.request.retries = 0
+        self.task.retry.side_effect = Retry()
+        self.ids = [
+            MediaMetadata.objects.create(
+                export=self.export,
+                subject_id=i,
+                url='https://example.org/{}.jpg'.format(i),
+                celery_task=self.task.request.id,
+            ).id
+            for i in range(3)
+        ]
+
+    def fetch_all(self, failing_url=None):
+        def fetch_all(jobs):
+            return [
+                (None, IOError(url)) if url == failing_url
+                else (MediaInfo(1, 'hash', None, None), None)
+                for url, _ in jobs
+            ]
+        return fetch_all
+
+    @mock.patch('hamlet.celery.finish_subject_set_export')
+    def test_retried_batch_finishes_export_once(self, finish_subject_set_export):
+        with self.assertRaises(Retry):
+            hamlet_celery.process_media_metadata_batch(
+                self.task,
+                self.ids,
+                self.fetch_all(failing_url='https://example.org/1.jpg'),
+            )
+        self.task.retry.assert_called_once()
+        retry_ids = self.task.retry.call_args[1]['args'][0]
+        self.assertEqual(retry_ids, [self.ids[1]])
+        self.export.refresh_from_db()
+        self.assertEqual(self.export.pending_media, 1)
+        finish_subject_set_export.assert_not_called()
 
-# Create your tests here.
+        # the retry keeps the task id, and a duplicate delivery of it
+        # finds nothing left to do
+        for _ in range(2):
+            hamlet_celery.process_media_metadata_batch(
+                self.task,
+                retry_ids,
+                self.fetch_all(),
+            )
+        self.export.refresh_from_db()
+        self.assertEqual(self.export.pending_media, 0)
+        finish_subject_set_export.assert_called_once()
+        self.assertFalse(MediaMetadata.objects.exclude(
+            status=MediaMetadata.COMPLETE,
+        ).exists())
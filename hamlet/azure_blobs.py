@@ -0,0 +1,232 @@
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+from azure.storage.blob import BlockBlobService, BlobPermissions
+from azure.storage.blob.models import BlobBlock
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+
+from exports.models import ManifestBlob
+
+
+@lru_cache(maxsize=None)
+def block_blob_service(account_name, account_key):
+    """Return the BlockBlobService for an Azure storage account.
+
+    One client (and its pool of connections) is shared by everything in
+    the process that uploads to the same account.
+    """
+    return BlockBlobService(account_name=account_name, account_key=account_key)
+
+
+class BlockBlobWriter:
+    """Write-only text file that uploads to an Azure block blob as it's written.
+
+    The text is encoded to UTF-8 and staged in blocks of
+    AZURE_UPLOAD_BLOCK_SIZE bytes, up to AZURE_UPLOAD_CONCURRENCY of them in
+    parallel. The staged blocks are only committed, creating (or replacing)
+    the blob, when the writer is closed without an error. The SHA-256 of the
+    content is computed as it's written.
+    """
+
+    def __init__(self, service, container_name, blob_name):
+        self.service = service
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.block_ids = []
+        self.buffer = []
+        self.buffer_size = 0
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.AZURE_UPLOAD_CONCURRENCY,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.sha256.update(data)
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= settings.AZURE_UPLOAD_BLOCK_SIZE:
+            self.stage_block()
+        return len(text)
+
+    def stage_block(self):
+        block = b''.join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+
+        # block ids must all be the same length within a blob
+        block_id = '{:08d}'.format(len(self.block_ids))
+        self.block_ids.append(block_id)
+
+        # wait for the oldest block first, so that only a bounded number of
+        # blocks are ever held in memory
+        if len(self.pending) >= settings.AZURE_UPLOAD_CONCURRENCY:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(
+            self.service.put_block,
+            self.container_name,
+            self.blob_name,
+            block,
+            block_id,
+        ))
+
+    def finish(self):
+        """Wait for every block to be staged, without committing them."""
+        if self.buffer or not self.block_ids:
+            self.stage_block()
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.executor.shutdown()
+
+    def commit(self):
+        return self.service.put_block_list(
+            self.container_name,
+            self.blob_name,
+            [BlobBlock(id=block_id) for block_id in self.block_ids],
+        )
+
+    def close(self):
+        self.finish()
+        return self.commit()
+
+    def abort(self):
+        # uncommitted blocks are garbage collected by Azure
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+
+
+class HashWriter:
+    """Write-only text file that only keeps the SHA-256 and size of its UTF-8 content."""
+
+    def __init__(self):
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(text)
+
+
+def upload_deduplicated_blob(service, container_name, blob_name, write_content, backup_f=None):
+    """Upload a blob, unless an identical one already exists, and return its name.
+
+    write_content(out_f) is called to write the content to a text file,
+    first only to hash it (and to write it to backup_f, if given). If the
+    hash is in the ManifestBlob index and that blob still exists in the
+    container, its name is returned without uploading anything. Otherwise
+    write_content is called again to upload the content to blob_name,
+    which is added to the index. The content must be the same both times.
+    """
+    hash_f = HashWriter()
+    write_content(hash_f if backup_f is None else TeeWriter(hash_f, backup_f))
+
+    account_name = service.account_name
+    existing = ManifestBlob.objects.filter(
+        account_name=account_name,
+        container_name=container_name,
+        sha256=hash_f.sha256.hexdigest(),
+    ).first()
+    if existing:
+        if service.exists(container_name, existing.blob_name):
+            return existing.blob_name
+        # the blob has been deleted from Azure since
+        existing.delete()
+
+    with BlockBlobWriter(service, container_name, blob_name) as blob_f:
+        write_content(blob_f)
+    try:
+        ManifestBlob.objects.create(
+            account_name=account_name,
+            container_name=container_name,
+            blob_name=blob_name,
+            sha256=blob_f.sha256.hexdigest(),
+            size=blob_f.size,
+        )
+    except IntegrityError:
+        # an identical manifest was uploaded by another export in the meantime
+        pass
+    return blob_name
+
+
+class TeeWriter:
+    """Write-only text file that writes everything to several files."""
+
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, text):
+        for out_f in self.files:
+            out_f.write(text)
+        return len(text)
+
+
+def shareable_blob_url(service, container_name, blob_name):
+    """Return a read-only URL to a blob, signed for SUBJECT_ASSISTANT_SAS_EXPIRY_DAYS.
+
+    Signing is done locally with the account key, so this doesn't make any
+    requests to Azure.
+    """
+    sas_expiry = datetime.utcnow() + timedelta(
+        days=settings.SUBJECT_ASSISTANT_SAS_EXPIRY_DAYS,
+    )
+    generated_sas = service.generate_blob_shared_access_signature(
+        container_name=container_name,
+        blob_name=blob_name,
+        permission=BlobPermissions(read=True),
+        expiry=sas_expiry,
+    )
+    return 'https://{}.blob.core.windows.net/{}/{}?{}'.format(
+        service.account_name,
+        container_name,
+        quote(blob_name),
+        generated_sas,
+    )
+
+
+def shareable_url_blob_name(url, container_name):
+    """Return the name of the blob a shareable URL points to, or None."""
+    prefix = '/{}/'.format(container_name)
+    path = urlparse(url).path
+    if not path.startswith(prefix):
+        return None
+    return unquote(path[len(prefix):]) or None
+
+
+def shareable_url_expiry(url):
+    """Return when the signature of a shareable URL expires, or None."""
+    expiry = parse_qs(urlparse(url).query).get('se')
+    if not expiry:
+        return None
+    for expiry_format in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d'):
+        try:
+            return timezone.make_aware(
+                datetime.strptime(expiry[0], expiry_format),
+                timezone.utc,
+            )
+        except ValueError:
+            pass
+    return None
@@ -0,0 +1,155 @@
+import csv
+import gzip
+import io
+import os
+import re
+import tempfile
+from contextlib import closing
+
+import requests
+
+from django.conf import settings
+
+# bytes of the response read from the socket at a time
+READ_BUFFER_SIZE = 1024 * 1024
+
+SUBJECT_ID_COLUMN = 'subject_id'
+MOST_LIKELY_COLUMN = 'data.most_likely'
+
+
+def iter_csv_rows(url):
+    """Yield the rows of a remote CSV file as lists of strings.
+
+    The response is decoded and parsed as it's downloaded, so only a
+    buffer's worth of the file is held in memory at a time.
+    """
+    with requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        # undo any gzip / deflate Content-Encoding as we read, and keep the
+        # raw response readable (rather than closed) at the end of the body
+        r.raw.decode_content = True
+        r.raw.auto_close = False
+        text = io.TextIOWrapper(
+            io.BufferedReader(r.raw, buffer_size=READ_BUFFER_SIZE),
+            encoding='utf-8',
+            newline='',
+        )
+        yield from csv.reader(text)
+
+
+def subject_consensus(reductions_url):
+    """Return a dict of subject id -> most likely label from a reductions CSV.
+
+    Only the first reduction of each subject is used.
+    """
+    consensus = {}
+    with closing(iter_csv_rows(reductions_url)) as rows:
+        header = next(rows, None)
+        if not header or MOST_LIKELY_COLUMN not in header:
+            return consensus
+
+        subject_id_index = header.index(SUBJECT_ID_COLUMN)
+        most_likely_index = header.index(MOST_LIKELY_COLUMN)
+        for row in rows:
+            if not row:
+                continue
+            consensus.setdefault(
+                int(row[subject_id_index]),
+                row[most_likely_index] if most_likely_index < len(row) else None,
+            )
+    return consensus
+
+
+def cache_path(data_request):
+    """Return the cache file for the parsed labels of a Caesar data request.
+
+    The data request's updated_at is part of the name, so a regenerated
+    reductions file is never served from the cache.
+    """
+    return os.path.join(
+        settings.CAESAR_CACHE_PATH,
+        'subject-reductions-{}-{}.csv.gz'.format(
+            int(data_request['id']),
+            re.sub(r'[^0-9A-Za-z]', '', str(data_request['updated_at'])),
+        ),
+    )
+
+
+def read_cached_consensus(path):
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as cache_f:
+            consensus = {
+                int(subject_id): label
+                for subject_id, label in csv.reader(cache_f)
+            }
+    except FileNotFoundError:
+        return None
+    # mark the entry as recently used, for eviction
+    os.utime(path)
+    return consensus
+
+
+def write_cached_consensus(path, consensus):
+    # write to a temporary file first so that other workers never read a
+    # partly written cache entry
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as raw_f, \
+                gzip.open(raw_f, 'wt', encoding='utf-8', newline='') as cache_f:
+            csv_writer = csv.writer(cache_f)
+            for subject_id, label in consensus.items():
+                csv_writer.writerow([subject_id, label])
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def evict_cached_consensus(max_size=None):
+    """Delete the least recently used cache entries beyond the size limit."""
+    if max_size is None:
+        max_size = settings.CAESAR_CACHE_MAX_SIZE
+
+    entries = []
+    with os.scandir(settings.CAESAR_CACHE_PATH) as cache_dir:
+        for entry in cache_dir:
+            if not entry.name.endswith('.csv.gz'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+def cached_subject_consensus(data_request):
+    """Return subject_consensus() for a Caesar data request, using the cache.
+
+    The parsed labels are kept on disk under CAESAR_CACHE_PATH, keyed by
+    the data request's id and updated_at, so repeat exports of an unchanged
+    data request skip the download entirely. Setting CAESAR_CACHE_MAX_SIZE
+    to 0 disables the cache.
+    """
+    if not settings.CAESAR_CACHE_MAX_SIZE:
+        return subject_consensus(data_request['url'])
+
+    path = cache_path(data_request)
+    consensus = read_cached_consensus(path)
+    if consensus is not None:
+        return consensus
+
+    consensus = subject_consensus(data_request['url'])
+    os.makedirs(settings.CAESAR_CACHE_PATH, exist_ok=True)
+    write_cached_consensus(path, consensus)
+    evict_cached_consensus()
+    return consensus
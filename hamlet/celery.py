@@ -1,17 +1,18 @@
 from __future__ import absolute_import, unicode_literals
 
-import base64
 import csv
-import hashlib
 import os
 import re
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 import django
 import requests
 
 from celery import Celery
 from celery.exceptions import MaxRetriesExceededError
+from celery.schedules import crontab
+from celery.utils import uuid
 
 from panoptes_client import Panoptes, SubjectSet, Workflow
 
@@ -22,13 +23,22 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hamlet.settings')
 django.setup()
 
 from django.conf import settings
-from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
 
-from exports.models import SubjectSetExport, MediaMetadata, WorkflowExport, MLSubjectAssistantExport, KadeSubjectAssistantExport
+from exports.models import SubjectSetExport, MediaMetadata, MediaMetadataCache, WorkflowExport, MLSubjectAssistantExport, KadeSubjectAssistantExport
 from .zooniverse_auth import SocialPanoptes
 from . import ms_ml_exports
 from . import kade_ml_exports
 from . import kade_service
+from . import caesar
+from . import export_files
+from . import media_fetch
+from . import media_fetch_async
+from . import subject_media
+from . import subject_snapshots
+from . import rate_limit
+from . import azure_blobs
 
 app = Celery('hamlet', broker=settings.REDIS_URI, backend=settings.REDIS_URI)
 
@@ -41,63 +51,367 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
+# Run by the worker's embedded beat scheduler (see start_worker.sh)
+app.conf.beat_schedule = {
+    'refresh-expiring-shareable-urls': {
+        'task': 'hamlet.celery.refresh_expiring_shareable_urls',
+        'schedule': crontab(hour=3, minute=0),
+    },
+    'evict-media-metadata-cache': {
+        'task': 'hamlet.celery.evict_media_metadata_cache',
+        'schedule': crontab(minute=30),
+    },
+}
+
 
 @app.task(bind=True)
 def subject_set_export(
     self,
     export_id,
     access_token,
+    incremental=None,
 ):
+    """Export the filesize and MD5 of every image in a subject set.
+
+    In incremental mode (the SUBJECT_SET_EXPORT_INCREMENTAL default), the
+    metadata of subject locations that were in the subject set's last
+    complete export is copied from it, and only new locations are fetched.
+    """
+    if incremental is None:
+        incremental = settings.SUBJECT_SET_EXPORT_INCREMENTAL
+
     export = SubjectSetExport.objects.get(pk=export_id)
     try:
         export.status = SubjectSetExport.RUNNING
+        # the enumeration itself counts as pending until it is finished, so
+        # the export can't be completed by fetches of the first few batches
+        export.pending_media = 1
         export.save()
-        with SocialPanoptes(bearer_token=access_token) as p:
-            subject_set = SubjectSet.find(export.subject_set_id)
-            for subject in subject_set.subjects:
-                for location in subject.locations:
-                    media_metadata = MediaMetadata.objects.create(
-                        export=export,
-                        subject_id=subject.id,
-                        url=list(location.values())[0],
-                    )
-                    task_result = fetch_media_metadata.delay(media_metadata.id)
-                    media_metadata.celery_task = task_result.id
-                    media_metadata.save()
-
-            task_result = update_subject_set_export_status.delay(export_id)
-            export.celery_task = task_result.id
-            export.save()
+
+        enumerate_subject_set(
+            export,
+            access_token,
+            previous_export=previous_complete_export(export) if incremental else None,
+        )
     except:
         export.status = SubjectSetExport.FAILED
-        export.save()
+        # don't overwrite the pending count with this instance's stale copy
+        export.save(update_fields=['status', 'modified'])
         raise
 
 
 @app.task(bind=True)
-def update_subject_set_export_status(
+def resume_subject_set_export(
     self,
     export_id,
+    access_token,
+    incremental=None,
 ):
+    """Continue a failed or interrupted subject set export.
+
+    Every MediaMetadata without a hash is queued to be fetched again, and
+    the subject set enumeration continues after the last snapshot location
+    that was checkpointed. Only exports that have failed, or stopped making
+    progress, are resumed (see SubjectSetExport.resumable).
+    """
+    if incremental is None:
+        incremental = settings.SUBJECT_SET_EXPORT_INCREMENTAL
+
     export = SubjectSetExport.objects.get(pk=export_id)
     try:
-        pending_metadata = export.mediametadata_set.filter(
-            status=MediaMetadata.PENDING,
+        batches = requeue_media_metadata(export)
+        if batches is None:
+            return
+        for batch_ids, task_id in batches:
+            dispatch_media_metadata_batch(batch_ids, task_id)
+
+        enumerate_subject_set(
+            export,
+            access_token,
+            previous_export=previous_complete_export(export) if incremental else None,
+            resume=True,
         )
-        if pending_metadata.count() > 0:
-            for mediametadata in pending_metadata:
-                mediametadata.check_status()
-            task_result = update_subject_set_export_status.apply_async(
-                args=(export_id,),
-                countdown=10,
+    except:
+        export.status = SubjectSetExport.FAILED
+        export.save(update_fields=['status', 'modified'])
+        raise
+
+
+def previous_complete_export(export):
+    return SubjectSetExport.objects.filter(
+        subject_set_id=export.subject_set_id,
+        status=SubjectSetExport.COMPLETE,
+        created__lt=export.created,
+    ).order_by('-created').first()
+
+
+def enumerate_subject_set(
+    export,
+    access_token,
+    previous_export=None,
+    resume=False,
+):
+    """Create and queue the MediaMetadata for each page of a subject set.
+
+    The subject locations are read from the subject set's shared snapshot.
+    If it has to be refreshed from Panoptes first, each page is used as soon
+    as the refresh has committed it. Otherwise the snapshot's complete
+    generation is read in order, and each page is checkpointed on the
+    export, as the (subject_id, frame_id) of its last location, in the same
+    transaction that saves its rows. The pending count held for the
+    enumeration is released at the end.
+
+    When resuming, enumeration continues after the checkpoint if its
+    snapshot generation can still be read. Otherwise it starts over, and
+    skips the locations which already have MediaMetadata.
+    """
+    batcher = MediaMetadataBatcher(export)
+
+    snapshot = None
+    if resume and export.snapshot_generation is not None:
+        # the user still has to have access to the subject set
+        with SocialPanoptes(bearer_token=access_token):
+            SubjectSet.find(export.subject_set_id)
+        snapshot = subject_snapshots.pinned_snapshot(
+            export.subject_set_id,
+            export.snapshot_generation,
+        )
+
+    if snapshot is None:
+        skip_existing = resume
+        # pages streamed from a refresh aren't in order, so can't be checkpointed
+        export.last_subject_id = None
+        export.last_frame_id = None
+        export.snapshot_generation = None
+        export.save(update_fields=[
+            'last_subject_id',
+            'last_frame_id',
+            'snapshot_generation',
+            'modified',
+        ])
+        with SocialPanoptes(bearer_token=access_token) as p:
+            snapshot, streamed = subject_snapshots.stream_fresh_snapshot(
+                p,
+                export.subject_set_id,
+                on_page=lambda locations: create_media_metadata_page(
+                    export,
+                    locations,
+                    batcher,
+                    previous_export=previous_export,
+                    skip_existing=skip_existing,
+                    checkpoint=False,
+                ),
             )
-            export.celery_task = task_result.id
-            export.save()
-            return
+        after = None
+    else:
+        skip_existing = False
+        streamed = False
+        after = None
+        if export.last_subject_id is not None:
+            after = (export.last_subject_id, export.last_frame_id)
+
+    if not streamed:
+        export.snapshot_generation = snapshot.generation
+        export.save(update_fields=['snapshot_generation', 'modified'])
+        for locations in subject_snapshots.iter_snapshot_pages(
+            snapshot,
+            after=after,
+        ):
+            create_media_metadata_page(
+                export,
+                locations,
+                batcher,
+                previous_export=previous_export,
+                skip_existing=skip_existing,
+            )
+    batcher.flush()
+
+    if export.finish_pending_media(1):
+        finish_subject_set_export(export)
+
+
+def requeue_media_metadata(export):
+    """Reassign all of a resumable export's MediaMetadata without a hash.
+
+    The export is locked while it's checked and its rows are given new
+    batch task ids, so the same export can't be resumed twice, and any old
+    tasks still around skip the rows. Its pending count is recounted from
+    the rows, plus one held for the enumeration.
+
+    Returns the (ids, task id) of each batch to be queued, or None if the
+    export isn't resumable.
+    """
+    batches = []
+    with transaction.atomic():
+        locked = SubjectSetExport.objects.select_for_update().get(pk=export.pk)
+        if not locked.resumable:
+            return None
+
+        incomplete_ids = list(locked.mediametadata_set.exclude(
+            status=MediaMetadata.COMPLETE,
+        ).values_list('id', flat=True))
+
+        batch_size = media_fetch_batch_size()
+        for i in range(0, len(incomplete_ids), batch_size):
+            batch_ids = incomplete_ids[i:i + batch_size]
+            task_id = uuid()
+            MediaMetadata.objects.filter(pk__in=batch_ids).update(
+                status=MediaMetadata.PENDING,
+                celery_task=task_id,
+            )
+            batches.append((batch_ids, task_id))
+
+        locked.status = SubjectSetExport.RUNNING
+        locked.pending_media = len(incomplete_ids) + 1
+        locked.save(update_fields=['status', 'pending_media', 'modified'])
+
+    export.status = locked.status
+    export.pending_media = locked.pending_media
+    return batches
+
+
+class MediaMetadataBatcher:
+    """Groups pending MediaMetadata into batches for the fetch tasks.
+
+    The task id of each batch is chosen up front and assigned to its rows
+    before they're created, so that queueing a batch doesn't need any
+    UPDATEs of the rows in it.
+    """
+
+    def __init__(self, export):
+        self.export = export
+        self.batch_size = media_fetch_batch_size()
+        self.assigned = 0
+        self.task_id = uuid()
+        self.pending_ids = []
+        self.pending_task_id = None
+
+    def assign(self, media_metadata):
+        if self.assigned == self.batch_size:
+            self.task_id = uuid()
+            self.assigned = 0
+        media_metadata.celery_task = self.task_id
+        self.assigned += 1
+
+    def add(self, media_metadata):
+        self.pending_ids.append(media_metadata.id)
+        self.pending_task_id = media_metadata.celery_task
+        if len(self.pending_ids) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending_ids:
+            self.export.add_pending_media(len(self.pending_ids))
+            dispatch_media_metadata_batch(self.pending_ids, self.pending_task_id)
+        self.pending_ids = []
+
+
+def create_media_metadata_page(
+    export,
+    locations,
+    batcher,
+    previous_export=None,
+    skip_existing=False,
+    checkpoint=True,
+):
+    """Bulk create the MediaMetadata for one page of subject set snapshot locations.
+
+    Locations that are unchanged since the previous export, or that have
+    fresh cached metadata, are created as complete. The rest are handed to
+    the batcher to be fetched. The last location of the page is saved as
+    the export's checkpoint, if checkpoint is set.
+    """
+    progress = {'modified': timezone.now()}
+    if checkpoint:
+        progress['last_subject_id'], progress['last_frame_id'], _ = locations[-1]
+    locations = [
+        (subject_id, url)
+        for subject_id, frame_id, url in locations
+    ]
+    urls = [url for _, url in locations]
+
+    if skip_existing:
+        existing = set(export.mediametadata_set.filter(
+            url__in=urls,
+        ).values_list('subject_id', 'url'))
+        locations = [
+            location for location in locations
+            if location not in existing
+        ]
+        urls = [url for _, url in locations]
+
+    previous_metadata = {}
+    if previous_export:
+        previous_metadata = {
+            (subject_id, url): (filesize, hash)
+            for subject_id, url, filesize, hash in previous_export.mediametadata_set.filter(
+                url__in=urls,
+                status=MediaMetadata.COMPLETE,
+            ).values_list('subject_id', 'url', 'filesize', 'hash')
+        }
+
+    cached_metadata = media_fetch.lookup_cached_media_metadata([
+        url for subject_id, url in locations
+        if (subject_id, url) not in previous_metadata
+    ])
+
+    page = []
+    for subject_id, url in locations:
+        media_metadata = MediaMetadata(
+            export=export,
+            subject_id=subject_id,
+            url=url,
+        )
+        previous = previous_metadata.get((subject_id, url))
+        cached = cached_metadata.get(url)
+        if previous:
+            media_metadata.filesize, media_metadata.hash = previous
+            media_metadata.status = MediaMetadata.COMPLETE
+        elif cached:
+            media_metadata.filesize = cached.filesize
+            media_metadata.hash = cached.hash
+            media_metadata.status = MediaMetadata.COMPLETE
+        else:
+            batcher.assign(media_metadata)
+        page.append(media_metadata)
+
+    with transaction.atomic():
+        MediaMetadata.objects.bulk_create(page)
+        SubjectSetExport.objects.filter(pk=export.pk).update(**progress)
+
+    for media_metadata in page:
+        if media_metadata.status == MediaMetadata.PENDING:
+            batcher.add(media_metadata)
+
+
+def finish_subject_set_export(export):
+    task_result = update_subject_set_export_status.delay(export.id)
+    export.celery_task = task_result.id
+    export.save(update_fields=['celery_task'])
+
+
+def finish_media_metadata(export_id, count):
+    """Complete the export once its last pending media item has finished."""
+    export = SubjectSetExport.objects.get(pk=export_id)
+    if export.finish_pending_media(count):
+        finish_subject_set_export(export)
+
+
+@app.task(bind=True)
+def update_subject_set_export_status(
+    self,
+    export_id,
+):
+    """Finish a subject set export after all its media has been fetched.
 
+    This is queued exactly once per export, by whichever task finishes the
+    last pending MediaMetadata.
+    """
+    export = SubjectSetExport.objects.get(pk=export_id)
+    try:
         if export.mediametadata_set.filter(
-            status=SubjectSetExport.FAILED
-        ).count() > 0:
+            status=MediaMetadata.FAILED
+        ).exists():
             export.status = SubjectSetExport.FAILED
             export.save()
         else:
@@ -117,52 +431,186 @@ def fetch_media_metadata(self, media_metadata_id):
         media_metadata.status = MediaMetadata.RUNNING
         media_metadata.save()
 
-        r = requests.get(media_metadata.url)
-        r.raise_for_status()
-
-        media_metadata.filesize = len(r.content)
-        media_metadata.hash = base64.b64encode(
-            hashlib.md5(r.content).digest()
-        ).decode()
+        metadata = media_fetch.fetch_cached_media_metadata(
+            media_metadata.url,
+            session=media_fetch.http_session(),
+        )
+        media_metadata.filesize = metadata.filesize
+        media_metadata.hash = metadata.hash
 
         media_metadata.status = MediaMetadata.COMPLETE
         media_metadata.save()
+        finish_media_metadata(media_metadata.export_id, 1)
     except Exception as e:
         try:
-            self.retry(countdown=60)
+            self.retry(countdown=rate_limit.retry_countdown(self.request.retries, e))
         except MaxRetriesExceededError:
             media_metadata.status = MediaMetadata.FAILED
             media_metadata.save()
+            finish_media_metadata(media_metadata.export_id, 1)
             raise e
 
 
+def media_fetch_batch_size():
+    if settings.MEDIA_FETCH_ENGINE == 'asyncio':
+        return settings.MEDIA_FETCH_ASYNC_BATCH_SIZE
+    return settings.MEDIA_FETCH_BATCH_SIZE
+
+
+def dispatch_media_metadata_batch(media_metadata_ids, task_id):
+    if settings.MEDIA_FETCH_ENGINE == 'asyncio':
+        task = fetch_media_metadata_async_batch
+    else:
+        task = fetch_media_metadata_batch
+    task.apply_async(args=(media_metadata_ids,), task_id=str(task_id))
+
+
+def process_media_metadata_batch(task, media_metadata_ids, fetch_all):
+    """Fetch the metadata for a batch of MediaMetadata and save the results.
+
+    fetch_all is called with a list of (url, stale cache entry or None)
+    tuples for the items that aren't already cached, and must return a list
+    of (MediaInfo, None) or (None, exception) tuples in the same order.
+    Only the failed items are retried.
+    """
+    # rows that have since been requeued by a resume belong to another task
+    batch = list(MediaMetadata.objects.filter(
+        pk__in=media_metadata_ids,
+        celery_task=task.request.id,
+    ).exclude(status=MediaMetadata.COMPLETE))
+    MediaMetadata.objects.filter(
+        pk__in=[media_metadata.id for media_metadata in batch],
+    ).update(status=MediaMetadata.RUNNING)
+
+    cache_entries = MediaMetadataCache.objects.in_bulk(
+        list({media_metadata.url for media_metadata in batch}),
+        field_name='url',
+    )
+    fresh_after = media_fetch.cache_fresh_after()
+
+    completed = []
+    to_fetch = []
+    for media_metadata in batch:
+        cache_entry = cache_entries.get(media_metadata.url)
+        if cache_entry and cache_entry.validated >= fresh_after:
+            media_metadata.filesize = cache_entry.filesize
+            media_metadata.hash = cache_entry.hash
+            media_metadata.status = MediaMetadata.COMPLETE
+            completed.append(media_metadata)
+        else:
+            to_fetch.append(media_metadata)
+
+    results = fetch_all([
+        (media_metadata.url, cache_entries.get(media_metadata.url))
+        for media_metadata in to_fetch
+    ])
+
+    fetched = {}
+    failed_ids = []
+    error = None
+    for media_metadata, (metadata, e) in zip(to_fetch, results):
+        if e:
+            failed_ids.append(media_metadata.id)
+            error = e
+            continue
+        media_metadata.filesize = metadata.filesize
+        media_metadata.hash = metadata.hash
+        media_metadata.status = MediaMetadata.COMPLETE
+        completed.append(media_metadata)
+        fetched[media_metadata.url] = metadata
+
+    MediaMetadata.objects.bulk_update(
+        completed,
+        ['filesize', 'hash', 'status'],
+        batch_size=500,
+    )
+    media_fetch.update_media_metadata_cache(fetched)
+
+    if not batch:
+        return
+    export_id = batch[0].export_id
+
+    if failed_ids:
+        finish_media_metadata(export_id, len(completed))
+        try:
+            task.retry(
+                args=(failed_ids,),
+                countdown=rate_limit.retry_countdown(task.request.retries, error),
+            )
+        except MaxRetriesExceededError:
+            MediaMetadata.objects.filter(
+                pk__in=failed_ids,
+            ).update(status=MediaMetadata.FAILED)
+            finish_media_metadata(export_id, len(failed_ids))
+            raise error
+    else:
+        finish_media_metadata(export_id, len(completed))
+
+
+@app.task(bind=True)
+def fetch_media_metadata_batch(self, media_metadata_ids):
+    """Fetch the metadata for a batch of MediaMetadata in parallel.
+
+    Files are fetched by a pool of MEDIA_FETCH_CONCURRENCY threads sharing
+    one keep-alive HTTP session.
+    """
+    session = media_fetch.http_session()
+
+    def fetch(job):
+        url, stale_entry = job
+        try:
+            return media_fetch.refresh_media_metadata(
+                url,
+                stale_entry=stale_entry,
+                session=session,
+            ), None
+        except Exception as e:
+            return None, e
+
+    def fetch_all(jobs):
+        with ThreadPoolExecutor(
+            max_workers=settings.MEDIA_FETCH_CONCURRENCY,
+        ) as executor:
+            return list(executor.map(fetch, jobs))
+
+    process_media_metadata_batch(self, media_metadata_ids, fetch_all)
+
+
+@app.task(bind=True)
+def fetch_media_metadata_async_batch(self, media_metadata_ids):
+    """Fetch the metadata for a large batch of MediaMetadata with asyncio."""
+    process_media_metadata_batch(
+        self,
+        media_metadata_ids,
+        media_fetch_async.fetch_media_metadata,
+    )
+
+
+@app.task
+def evict_media_metadata_cache():
+    media_fetch.evict_media_metadata_cache()
+
+
 @app.task(bind=True)
 def write_subject_set_export(self, export_id):
     export = SubjectSetExport.objects.get(pk=export_id)
     try:
-        with tempfile.NamedTemporaryFile(
-            'w+',
-            encoding='utf-8',
-            dir=settings.TMP_STORAGE_PATH,
-            delete=False,
+        with export_files.open_export_file(
+            export.csv,
+            'subject-set-{}-export{}.tsv'.format(
+                export.subject_set_id,
+                export.id,
+            ),
         ) as out_f:
             csv_writer = csv.writer(out_f, dialect='excel-tab')
             csv_writer.writerow(['TsvHttpData-1.0'])
-            for media_metadata in export.mediametadata_set.all():
-                csv_writer.writerow([
-                    media_metadata.url,
-                    media_metadata.filesize,
-                    media_metadata.hash,
-                ])
-            out_f.flush()
-            out_f_name = out_f.name
-        with open(out_f_name, 'rb') as out_f:
-            export.csv.save(
-                'subject-set-{}-export{}.tsv'.format(
-                    export.subject_set_id,
-                    export.id,
-                ),
-                File(out_f),
+            # only fetch the columns we need, through a server side cursor
+            csv_writer.writerows(
+                export.mediametadata_set.values_list(
+                    'url',
+                    'filesize',
+                    'hash',
+                ).iterator(chunk_size=settings.EXPORT_QUERY_CHUNK_SIZE)
             )
         export.status = SubjectSetExport.COMPLETE
         export.save()
@@ -173,8 +621,6 @@ def write_subject_set_export(self, export_id):
             export.status = SubjectSetExport.FAILED
             export.save()
             raise e
-    finally:
-        os.unlink(out_f_name)
 
 
 class ExportFailure(Exception):
@@ -227,47 +673,30 @@ def workflow_export(
             if not latest_reductions.get('url'):
                 raise ExportFailure
 
-            export_data = requests.get(latest_reductions.get('url')).content
-            export_data = export_data.decode('utf-8')
-            r = csv.DictReader(export_data.splitlines())
-            subject_consensus = {}
-            for row in r:
-                if "data.most_likely" in row:
-                    subject_consensus.setdefault(
-                        int(row['subject_id']),
-                        row['data.most_likely'],
-                    )
-
-            with tempfile.NamedTemporaryFile(
-                'w+',
-                encoding='utf-8',
-                dir=settings.TMP_STORAGE_PATH,
-                delete=False,
-            ) as out_f:
-                csv_writer = csv.writer(out_f)
-                for media_metadata in MediaMetadata.objects.filter(
-                    subject_id__in=subject_consensus.keys(),
-                ).values('subject_id', 'url').distinct():
+            subject_consensus = caesar.cached_subject_consensus(
+                latest_reductions,
+            )
+
+            with export_files.open_table_export_file(
+                export.csv,
+                'workflow-{}-export{}'.format(
+                    export.workflow_id,
+                    export.id,
+                ),
+                export.output_format,
+                ['url', 'label'],
+            ) as csv_writer:
+                for subject_id, url in subject_media.iter_subject_media_urls(
+                    subject_consensus.keys(),
+                ):
                     csv_writer.writerow([
                         "gs://{}/{}".format(
                             storage_prefix,
-                            re.sub(r'^https?://', '', media_metadata['url']),
+                            re.sub(r'^https?://', '', url),
                         ),
-                        subject_consensus[media_metadata['subject_id']],
+                        subject_consensus[subject_id],
                     ])
 
-                out_f.flush()
-                out_f_name = out_f.name
-
-            with open(out_f_name, 'rb') as out_f:
-                export.csv.save(
-                    'workflow-{}-export{}.csv'.format(
-                        export.workflow_id,
-                        export.id,
-                    ),
-                    File(out_f),
-                )
-
             export.status = WorkflowExport.COMPLETE
             export.save()
     except Exception as e:
@@ -277,8 +706,6 @@ def workflow_export(
             export.status = WorkflowExport.FAILED
             export.save()
             raise e
-    finally:
-        os.unlink(out_f_name)
 
 
 @app.task(bind=True)
@@ -309,34 +736,47 @@ def ml_subject_assistant_export_to_microsoft(
             export.subject_set_id,
             export.id,
         )
-        source_filepath = ''
 
         export.status = MLSubjectAssistantExport.RUNNING
         export.save()
 
-        # Get the Subjects data
-        data = ms_ml_exports.ml_subject_assistant_export_to_microsoft_pt1_get_subjects_data(export_id, access_token)
-
-        # Create the file to be exported
-        source_filepath = ms_ml_exports.ml_subject_assistant_export_to_microsoft_pt2_create_file(export_id, data, target_filename)
-
-        # Upload the file to Azure, and get a shareable URL to the file
-        shareable_file_url = ms_ml_exports.ml_subject_assistant_export_to_microsoft_pt3_create_shareable_azure_blob(source_filepath, target_filename)
-
-        # Save the created file to the database
-        # NOTE: this is technically optional, and only used as a backup
-        with open(source_filepath, 'rb') as out_f:
-            export.json.save(
-                target_filename,
-                File(out_f),
-            )
+        # A retry after the shards were uploaded only submits the shards
+        # whose ML tasks haven't been submitted yet
+        if not export.shard_azure_urls:
+            # Get the Subjects data
+            snapshot = ms_ml_exports.ml_subject_assistant_export_to_microsoft_pt1_get_subjects_data(export_id, access_token)
+
+            # Upload the file to Azure (in shards, if it's large), while saving
+            # a copy of it to the database
+            # NOTE: the copy is technically optional, and only used as a backup
+            with export_files.open_export_file(export.json, target_filename) as backup_f:
+                blob_names = ms_ml_exports.ml_subject_assistant_export_to_microsoft_pt2_upload_shards(snapshot, target_filename, backup_f)
+
+            # Get a shareable URL to each file
+            shareable_file_urls = [
+                ms_ml_exports.ml_subject_assistant_export_to_microsoft_pt3_create_shareable_azure_blob(blob_name)
+                for blob_name in blob_names
+            ]
+
+            # Save a refrence to the shareable URLs. The first shard's is shown
+            # in the UI.
+            # NOTE: these shareable URLs have a shelf life.
+            export.azure_url = shareable_file_urls[0]
+            export.shard_azure_urls = shareable_file_urls
+            export.shard_ml_task_uuids = [None] * len(shareable_file_urls)
+            export.save()
 
-        # Save a refrence to the shareable URL.
-        # NOTE: these shareable URLs have a shelf life.
-        export.azure_url = shareable_file_url
+        def save_ml_task_uuids(ml_task_uuids):
+            export.shard_ml_task_uuids = ml_task_uuids
+            export.save(update_fields=['shard_ml_task_uuids', 'modified'])
 
-        # Submit the ML task request to the ML service
-        export.ml_task_uuid = ms_ml_exports.ml_subject_assistant_export_to_microsoft_pt4_make_ml_request(shareable_file_url)
+        # Submit an ML task request for each shard to the ML service
+        export.shard_ml_task_uuids = ms_ml_exports.ml_subject_assistant_export_to_microsoft_pt4_make_ml_requests(
+            export.shard_azure_urls,
+            export.shard_ml_task_uuids,
+            save_ml_task_uuids,
+        )
+        export.ml_task_uuid = export.shard_ml_task_uuids[0]
 
         # SUCCESS
         export.status = MLSubjectAssistantExport.COMPLETE
@@ -350,14 +790,6 @@ def ml_subject_assistant_export_to_microsoft(
             export.save()
             raise err
 
-    finally:
-        # Clean up the temporary file, if it exists.
-        try:
-            if len(source_filepath) > 0:
-                os.unlink(source_filepath)
-        except OSError:
-            pass
-
 
 @app.task(bind=True)
 def zoobot_subject_assistant_export_to_kade(
@@ -383,27 +815,44 @@ def zoobot_subject_assistant_export_to_kade(
     try:
         export = KadeSubjectAssistantExport.objects.get(pk=export_id)
         target_filename = f'catalogues/{kade_service.env_string()}/zoobot-subject-assistant-{export.subject_set_id}-export{export.id}.json'
-        source_filepath = ''
 
         export.status = KadeSubjectAssistantExport.RUNNING
         export.save()
 
-        # Get the Subjects data
-        data = kade_ml_exports.subject_assistant_export_get_subjects_data(export, access_token)
-
-        # Create the file to be exported
-        source_filepath = kade_ml_exports.subject_assistant_export_to_create_export_file(data)
-
-        # Upload the file to Azure, and get a shareable URL to the file
-        shareable_file_url = kade_ml_exports.subject_assistant_export_to_shareable_blob_storage_location(source_filepath, target_filename)
+        # A retry after the shards were uploaded only submits the shards
+        # whose prediction jobs haven't been submitted yet
+        if not export.shard_azure_urls:
+            # Get the Subjects data
+            snapshot = kade_ml_exports.subject_assistant_export_get_subjects_data(export, access_token)
+
+            # Upload the file to Azure (in shards, if it's large)
+            blob_names = kade_ml_exports.subject_assistant_export_to_upload_export_shards(snapshot, target_filename)
+
+            # Get a shareable URL to each file
+            shareable_file_urls = [
+                kade_ml_exports.subject_assistant_export_to_shareable_blob_storage_location(blob_name)
+                for blob_name in blob_names
+            ]
+
+            # Save a refrence to the shareable URLs. The first shard's is shown
+            # in the UI.
+            # NOTE: these shareable URLs have a shelf life.
+            export.azure_url = shareable_file_urls[0]
+            export.shard_azure_urls = shareable_file_urls
+            export.shard_service_job_urls = [None] * len(shareable_file_urls)
+            export.save()
 
-        # Save a refrence to the shareable URL.
-        # NOTE: these shareable URLs have a shelf life.
-        export.azure_url = shareable_file_url
+        def save_service_job_urls(service_job_urls):
+            export.shard_service_job_urls = service_job_urls
+            export.save(update_fields=['shard_service_job_urls', 'modified'])
 
-        # Submit the ML task request to the ML service
-        kade_service_job_id = kade_ml_exports.subject_assistant_export_to_kade(shareable_file_url)
-        export.service_job_url = f'{kade_service.public_url()}/{kade_service_job_id}'
+        # Submit a prediction job for each shard to the ML service
+        export.shard_service_job_urls = kade_ml_exports.subject_assistant_export_to_kade_shards(
+            export.shard_azure_urls,
+            export.shard_service_job_urls,
+            save_service_job_urls,
+        )
+        export.service_job_url = export.shard_service_job_urls[0]
 
         # SUCCESS
         export.status = KadeSubjectAssistantExport.COMPLETE
@@ -417,10 +866,31 @@ def zoobot_subject_assistant_export_to_kade(
             export.save()
             raise err
 
-    finally:
-        # Clean up the temporary file, if it exists.
-        try:
-            if len(source_filepath) > 0:
-                os.unlink(source_filepath)
-        except OSError:
-            pass
+
+@app.task
+def refresh_expiring_shareable_urls():
+    """Re-sign the shareable URLs of ML exports that are about to expire.
+
+    Only links expiring within SUBJECT_ASSISTANT_SAS_REFRESH_DAYS are
+    refreshed; links that have already expired are left to be refreshed on
+    request, since nobody may be using them any more.
+    """
+    now = timezone.now()
+    refresh_before = now + timedelta(days=settings.SUBJECT_ASSISTANT_SAS_REFRESH_DAYS)
+
+    for model, refresh_shareable_url in (
+        (MLSubjectAssistantExport, ms_ml_exports.refresh_shareable_url),
+        (KadeSubjectAssistantExport, kade_ml_exports.refresh_shareable_url),
+    ):
+        for export in model.objects.filter(
+            status=model.COMPLETE,
+            azure_url__isnull=False,
+        ).iterator():
+            expiry = azure_blobs.shareable_url_expiry(export.azure_url)
+            if expiry is None or not now < expiry <= refresh_before:
+                continue
+            try:
+                refresh_shareable_url(export)
+            except Exception as err:
+                # carry on with the rest of the exports
+                print('[ERROR] ', err)
@@ -0,0 +1,168 @@
+import csv
+import gzip
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# pyarrow is only needed for Parquet exports
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class ParquetUnavailable(Exception):
+    pass
+
+
+def parquet_available():
+    return pyarrow is not None
+
+
+class EncodedWriter:
+    """Write-only text wrapper around a binary file, e.g. for csv.writer."""
+
+    def __init__(self, binary_file, encoding='utf-8'):
+        self.binary_file = binary_file
+        self.encoding = encoding
+
+    def write(self, text):
+        return self.binary_file.write(text.encode(self.encoding))
+
+
+class PositionWriter:
+    """Write-only binary wrapper that keeps track of its own position.
+
+    Storage backends that upload as they go can't always tell() where they
+    are in the file, which Parquet writers need to do.
+    """
+
+    closed = False
+
+    def __init__(self, binary_file):
+        self.binary_file = binary_file
+        self.position = 0
+
+    def write(self, data):
+        self.binary_file.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class ParquetRowWriter:
+    """Write rows of strings to a Parquet file, a row group at a time."""
+
+    def __init__(self, binary_file, columns):
+        if pyarrow is None:
+            raise ParquetUnavailable(
+                'Please install pyarrow to export Parquet files'
+            )
+        self.columns = columns
+        self.schema = pyarrow.schema([
+            (column, pyarrow.string()) for column in columns
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(
+            PositionWriter(binary_file),
+            self.schema,
+        )
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= settings.EXPORT_PARQUET_ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(pyarrow.Table.from_arrays(
+                [
+                    pyarrow.array([row[i] for row in self.rows], pyarrow.string())
+                    for i in range(len(self.columns))
+                ],
+                schema=self.schema,
+            ))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def discard_export_file(storage, name, out_f):
+    """Throw away a partly written export file, rather than saving it.
+
+    Closing an S3Boto3StorageFile completes its multipart upload with the
+    parts sent so far, so its upload is aborted instead of closing it.
+    Anything saved under the file's name is then deleted from storage.
+    """
+    if hasattr(out_f, '_multipart'):
+        if out_f._multipart is not None:
+            out_f._multipart.abort()
+    else:
+        out_f.close()
+    storage.delete(name)
+
+
+@contextmanager
+def open_export_file(field_file, filename, binary=False):
+    """Open a new file for a FileField directly on its storage backend.
+
+    Rows can be written to the file as they are generated: with
+    S3Boto3Storage the data is sent as a multipart upload, buffered in
+    memory one AWS_S3_FILE_BUFFER_SIZE part at a time, so nothing is
+    written to local disk. The field is only pointed at the new file (and
+    its model instance saved) once the file has been written successfully.
+
+    Yields a text file unless `binary` is set.
+    """
+    field = field_file.field
+    storage = field_file.storage
+    name = storage.get_available_name(
+        field.generate_filename(field_file.instance, filename),
+        max_length=field.max_length,
+    )
+
+    out_f = storage.open(name, 'wb')
+    try:
+        yield out_f if binary else EncodedWriter(out_f)
+    except BaseException:
+        discard_export_file(storage, name, out_f)
+        raise
+    out_f.close()
+
+    setattr(field_file.instance, field.name, name)
+    field_file.instance.save()
+
+
+@contextmanager
+def open_table_export_file(field_file, filename, output_format, columns):
+    """Open a new export file of rows as 'csv', 'csv.gz' or 'parquet'.
+
+    Yields an object with a csv.writer style writerow() method. CSV files
+    have no header row, while the columns of Parquet files are named after
+    `columns`.
+    """
+    filename = '{}.{}'.format(filename, output_format)
+    with open_export_file(field_file, filename, binary=True) as out_f:
+        if output_format == 'parquet':
+            writer = ParquetRowWriter(out_f, columns)
+            yield writer
+            writer.close()
+        elif output_format == 'csv.gz':
+            with gzip.GzipFile(fileobj=out_f, mode='wb') as gzip_f:
+                yield csv.writer(EncodedWriter(gzip_f))
+        else:
+            yield csv.writer(EncodedWriter(out_f))
@@ -1,9 +1,5 @@
-from azure.storage.blob import BlockBlobService, BlobPermissions
-import json
 import os
-import tempfile
 import requests
-from datetime import datetime, timedelta
 
 import django
 # set the default Django settings module for the 'celery' program.
@@ -12,9 +8,9 @@ django.setup()
 
 from django.conf import settings
 
-from .zooniverse_auth import SocialPanoptes
+from . import azure_blobs
+from . import manifests
 from . import kade_service
-from panoptes_client import SubjectSet
 
 
 def subject_assistant_export_get_subjects_data(
@@ -23,103 +19,63 @@ def subject_assistant_export_get_subjects_data(
 ):
     print('[Subject Assistant] Exporting to KaDE: get Subjects')
 
-    # Keeps track of all data items that needs to written into the export JSON format.
-    data = []
+    # The data items are only generated (from the Subject Set's snapshot)
+    # while the export files are being written.
+    return manifests.subject_set_snapshot(access_token, export.subject_set_id)
 
-    # Retrieve all Subjects from a Subject Set
-    with SocialPanoptes(bearer_token=access_token) as sp:
-        subject_set = SubjectSet.find(export.subject_set_id)
 
-        # Process each Subject
-        for subject in subject_set.subjects:
+def azure_blob_service():
+    return azure_blobs.block_blob_service(
+        settings.KADE_SUBJECT_ASSISTANT_AZURE_ACCOUNT_NAME,
+        settings.KADE_SUBJECT_ASSISTANT_AZURE_ACCOUNT_KEY,
+    )
 
-            # Create a data item for each image URL in the Subject
-            for frame_id, location in enumerate(subject.locations):
-                image_url = list(location.values())[0]
 
-                subject_information = {
-                    'project_id': str(subject_set.links.project.id),
-                    'subject_set_id': str(export.subject_set_id),
-                    'subject_id': str(subject.id),
-                    'frame_id': str(frame_id)
-                }
+def subject_assistant_export_to_upload_export_file(data, target_filename, backup_f=None):
 
-                item = []
-                item.append(image_url)
-                # The subject's JSON information is stored as a string. Yes, really.
-                item.append(json.dumps(subject_information))
+    print('[Subject Assistant] Exporting to KaDE: upload file to blob storage')
 
-                data.append(item)
-
-    return data
-
-
-def subject_assistant_export_to_create_export_file(data):
-
-    print('[Subject Assistant] Exporting to KaDE: create file')
-
-    # Write the data to a file
-    source_filepath = ''
     try:
-        # First create a temporary JSON file
-        with tempfile.NamedTemporaryFile(
-            'w+',
-            encoding='utf-8',
-            dir=settings.TMP_STORAGE_PATH,
-            delete=False,
-        ) as out_f:
-            json.dump(data, out_f)
-            out_f.flush()
-            source_filepath = out_f.name
-
-        return source_filepath
+        # data() generates the data items again each time it's called. They
+        # are hashed (and streamed into the backup file) first, and only
+        # streamed into an Azure blob if there isn't an identical file on
+        # Azure already.
+        return azure_blobs.upload_deduplicated_blob(
+            azure_blob_service(),
+            settings.KADE_SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME,
+            target_filename,
+            lambda out_f: manifests.write_manifest(out_f, data()),
+            backup_f,
+        )
 
     except Exception as err:
-
         print('[ERROR] ', err)
-
-        # Only cleanup the temporary file on error; otherwise it'll be cleaned up in the main function.
-        try:
-            if len(source_filepath) > 0:
-                os.unlink(source_filepath)
-        except OSError:
-            pass
-
         raise err
 
 
-def subject_assistant_export_to_shareable_blob_storage_location(
-    source_filepath,
-    target_filename,
-):
-
-    print('[Subject Assistant] Exporting to KaDE: upload to shareable blob storage location')
+def subject_assistant_export_to_upload_export_shards(snapshot, target_filename):
+    """Upload the manifest in shards of SUBJECT_ASSISTANT_SHARD_SIZE items, in parallel.
 
-    shareable_file_url = ''
+    Returns the blob name of each shard.
+    """
+    return manifests.upload_manifest_shards(
+        snapshot,
+        target_filename,
+        subject_assistant_export_to_upload_export_file,
+    )
 
-    try:
-        block_blob_service = BlockBlobService(
-            account_name=settings.KADE_SUBJECT_ASSISTANT_AZURE_ACCOUNT_NAME,
-            account_key=settings.KADE_SUBJECT_ASSISTANT_AZURE_ACCOUNT_KEY)
 
-        block_blob_service.create_blob_from_path(
-            settings.KADE_SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME, target_filename, source_filepath)
+def subject_assistant_export_to_shareable_blob_storage_location(blob_name):
 
-        blob_permissions = BlobPermissions(read=True)
-        sas_expiry = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d')
+    print('[Subject Assistant] Exporting to KaDE: create shareable blob storage location')
 
-        generated_sas = block_blob_service.generate_blob_shared_access_signature(
-            container_name=settings.KADE_SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME,
-            blob_name=target_filename,
-            permission=blob_permissions,
-            expiry=sas_expiry
-        )
+    shareable_file_url = ''
 
-        shareable_file_url = 'https://{}.blob.core.windows.net/{}/{}?{}'.format(
-            settings.KADE_SUBJECT_ASSISTANT_AZURE_ACCOUNT_NAME,
+    try:
+        shareable_file_url = azure_blobs.shareable_blob_url(
+            azure_blob_service(),
             settings.KADE_SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME,
-            target_filename,
-            generated_sas
+            blob_name,
         )
 
     except Exception as err:
@@ -129,6 +85,35 @@ def subject_assistant_export_to_shareable_blob_storage_location(
     return shareable_file_url
 
 
+def refresh_shareable_url(export):
+    """Replace an export's expiring shareable URL with a newly signed one.
+
+    The blob that was uploaded for the export is reused as is, so this
+    doesn't need the export to be run again.
+    """
+    print('[Subject Assistant] Refreshing shareable KaDE blob storage location for export {}'.format(export.id))
+
+    blob_names = [
+        url and azure_blobs.shareable_url_blob_name(
+            url,
+            settings.KADE_SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME,
+        )
+        for url in export.shard_azure_urls or [export.azure_url]
+    ]
+    if not all(blob_names):
+        raise ValueError('Export {} has no Azure blob to share'.format(export.id))
+
+    shareable_file_urls = [
+        subject_assistant_export_to_shareable_blob_storage_location(blob_name)
+        for blob_name in blob_names
+    ]
+    export.azure_url = shareable_file_urls[0]
+    if export.shard_azure_urls:
+        export.shard_azure_urls = shareable_file_urls
+    export.save(update_fields=['azure_url', 'shard_azure_urls', 'modified'])
+    return export.azure_url
+
+
 def subject_assistant_export_to_kade(shareable_file_url):
 
     print('[Subject Assistant] Exporting to KaDE: make request to KaDE Prediction API service')
@@ -162,3 +147,18 @@ def subject_assistant_export_to_kade(shareable_file_url):
 
     return kade_job_id
 
+
+def subject_assistant_export_to_kade_shard(shareable_file_url):
+    """Submit a KaDE prediction job for a shard of the manifest, returning its URL."""
+    kade_service_job_id = subject_assistant_export_to_kade(shareable_file_url)
+    return f'{kade_service.public_url()}/{kade_service_job_id}'
+
+
+def subject_assistant_export_to_kade_shards(shareable_file_urls, service_job_urls, on_submitted):
+    """Submit a KaDE prediction job for each shard of the manifest without one yet, in parallel."""
+    return manifests.submit_manifest_shards(
+        subject_assistant_export_to_kade_shard,
+        shareable_file_urls,
+        service_job_urls,
+        on_submitted,
+    )
@@ -0,0 +1,180 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connection
+
+from .zooniverse_auth import SocialPanoptes
+from . import subject_snapshots
+
+
+def escape_json_string(value):
+    """Return `value` escaped to go inside a JSON string, without quotes."""
+    return json.dumps(value)[1:-1]
+
+
+def iter_manifest_items(snapshot, after=None, through=None):
+    """Yield a subject manifest item for each image URL in a Subject Set snapshot.
+
+    Only the items for locations after the (subject_id, frame_id) given, up
+    to and including the one given as through, are yielded. Each item is
+    yielded already serialised to JSON, formatted so:
+
+    [ "http://image.url/example.png",
+      "{ \"subject_info\": \"is a stringified JSON object\" }" ]
+
+    The subject information is the same as json.dumps() of a dict of
+    project_id, subject_set_id, subject_id and frame_id, but only the parts
+    that change between items are serialised for each item.
+    """
+    # The subject's JSON information is stored as a string. Yes, really.
+    # Everything before the subject id is the same for every item.
+    constant_information = escape_json_string(json.dumps({
+        'project_id': str(snapshot.project_id),
+        'subject_set_id': str(snapshot.subject_set_id),
+    })[:-1] + ', ')
+
+    subject_id = None
+    subject_information = None
+    for location_subject_id, frame_id, image_url in subject_snapshots.iter_snapshot_locations(
+        snapshot,
+        after,
+        through,
+    ):
+        if location_subject_id != subject_id:
+            subject_id = location_subject_id
+            subject_information = constant_information + escape_json_string(
+                '"subject_id": {}, "frame_id": '.format(
+                    json.dumps(str(subject_id)),
+                )
+            )
+
+        yield '[{}, "{}{}"]'.format(
+            json.dumps(image_url),
+            subject_information,
+            escape_json_string('"{}"}}'.format(frame_id)),
+        )
+
+
+def subject_set_snapshot(access_token, subject_set_id):
+    """Return the fresh snapshot of a Subject Set, as a Panoptes user."""
+    with SocialPanoptes(bearer_token=access_token) as p:
+        return subject_snapshots.fresh_snapshot(p, subject_set_id)
+
+
+def write_manifest(out_f, items):
+    """Write serialised manifest items to a text file as a JSON array.
+
+    Each item is written as soon as it's generated, so the manifest is
+    never held in memory as a whole. The output is identical to json.dump()
+    of a list of the items.
+    """
+    out_f.write('[')
+    for i, item in enumerate(items):
+        if i:
+            out_f.write(', ')
+        out_f.write(item)
+    out_f.write(']')
+
+
+def shard_bounds(snapshot, shard_size=None):
+    """Return the (after, through) location keys of each shard of a snapshot's manifest.
+
+    Manifests are split into shards of SUBJECT_ASSISTANT_SHARD_SIZE items,
+    or not at all if that's 0. Shards are bounded by the (subject_id,
+    frame_id) of their last location, in the generation the snapshot was
+    loaded at, and the last one is left open ended.
+    """
+    if shard_size is None:
+        shard_size = settings.SUBJECT_ASSISTANT_SHARD_SIZE
+    item_count = snapshot.location_count
+    if not shard_size or item_count <= shard_size:
+        return [(None, None)]
+    ends = [
+        subject_snapshots.location_key_at(snapshot, index)
+        for index in range(shard_size - 1, item_count - 1, shard_size)
+    ]
+    return list(zip([None] + ends, ends + [None]))
+
+
+def shard_filename(filename, shard_number):
+    """Return the file name of one shard of a manifest, e.g. export1-shard2.json"""
+    root, ext = os.path.splitext(filename)
+    return '{}-shard{}{}'.format(root, shard_number, ext)
+
+
+def upload_manifest_shards(snapshot, filename, upload_file, backup_f=None):
+    """Upload the manifest of a Subject Set snapshot in shards, in parallel.
+
+    upload_file(items, filename, backup_f) is called for each shard, where
+    items() generates the shard's items, with up to
+    SUBJECT_ASSISTANT_SHARD_CONCURRENCY shards being generated and
+    uploaded at a time, and the list of what it returned for each shard is
+    returned in order. The whole manifest is written to backup_f as well,
+    if given.
+    """
+    shards = shard_bounds(snapshot)
+    if len(shards) == 1:
+        return [upload_file(
+            lambda: iter_manifest_items(snapshot),
+            filename,
+            backup_f,
+        )]
+
+    def upload_shard(shard_number, after, through):
+        try:
+            return upload_file(
+                lambda: iter_manifest_items(snapshot, after, through),
+                shard_filename(filename, shard_number),
+                None,
+            )
+        finally:
+            # each thread has its own database connection
+            connection.close()
+
+    with ThreadPoolExecutor(
+        max_workers=settings.SUBJECT_ASSISTANT_SHARD_CONCURRENCY,
+    ) as executor:
+        futures = [
+            executor.submit(upload_shard, shard_number, after, through)
+            for shard_number, (after, through) in enumerate(shards, 1)
+        ]
+        if backup_f is not None:
+            write_manifest(backup_f, iter_manifest_items(snapshot))
+        return [future.result() for future in futures]
+
+
+def submit_manifest_shards(submit_job, shareable_urls, jobs, on_submitted):
+    """Submit a job for each shard of a manifest that doesn't have one yet, in parallel.
+
+    `jobs` lists what submit_job(shareable_url) returned for each shard in an
+    earlier attempt, or None for the shards still to be submitted.
+    on_submitted(jobs) is called from this thread every time another shard
+    has been submitted, so that its job can be saved straight away. When a
+    submission fails, the others still finish (and are saved) before the
+    error is raised, so a retry only submits the shards that failed.
+
+    Returns the job of every shard, in order.
+    """
+    jobs = list(jobs)
+    error = None
+    with ThreadPoolExecutor(
+        max_workers=settings.SUBJECT_ASSISTANT_SHARD_CONCURRENCY,
+    ) as executor:
+        futures = {
+            executor.submit(submit_job, shareable_url): index
+            for index, shareable_url in enumerate(shareable_urls)
+            if jobs[index] is None
+        }
+        for future in as_completed(futures):
+            try:
+                jobs[futures[future]] = future.result()
+            except Exception as err:
+                error = error or err
+                continue
+            on_submitted(jobs)
+
+    if error:
+        raise error
+    return jobs
@@ -0,0 +1,538 @@
+import base64
+import binascii
+import hashlib
+import os
+import re
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+import requests.adapters
+
+import django
+# set the default Django settings module for the 'celery' program.
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hamlet.settings')
+django.setup()
+
+from django.conf import settings
+from django.utils import timezone
+
+from exports.models import MediaMetadataCache
+from . import rate_limit
+
+# S3 style ETags are the hex MD5 of the object unless it was a multipart
+# upload, in which case they look like "<md5 of part md5s>-<part count>"
+SINGLE_PART_ETAG = re.compile(r'^[0-9a-fA-F]{32}$')
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+# hash is the base64 encoded MD5 of the file, etag and last_modified are the
+# response validators (if any) used to revalidate cached metadata
+MediaInfo = namedtuple('MediaInfo', ['filesize', 'hash', 'etag', 'last_modified'])
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class MemoryBudget:
+    """A number of bytes that threads can reserve to hold in memory.
+
+    Reservations bigger than the whole budget are reduced to it, so that
+    they can still be made once nothing else is reserved.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    def try_acquire(self, size):
+        """Reserve size bytes if they're available, returning the bytes reserved or 0."""
+        size = min(size, self.size)
+        with self.condition:
+            if self.reserved + size > self.size:
+                return 0
+            self.reserved += size
+            return size
+
+    def acquire(self, size):
+        """Wait until size bytes are available and reserve them."""
+        size = min(size, self.size)
+        with self.condition:
+            self.condition.wait_for(lambda: self.reserved + size <= self.size)
+            self.reserved += size
+            return size
+
+    def release(self, size):
+        with self.condition:
+            self.reserved -= size
+            self.condition.notify_all()
+
+
+_range_memory_budget = None
+_ranged_download_slots = None
+_ranged_lock = threading.Lock()
+
+
+def range_memory_budget():
+    """Return the MemoryBudget shared by every range downloaded in this process.
+
+    Ranges are read into memory whole, so MEDIA_FETCH_RANGE_MEMORY_BUDGET
+    bytes of them at most are in flight at once across all the threads.
+    """
+    global _range_memory_budget
+    with _ranged_lock:
+        if _range_memory_budget is None:
+            _range_memory_budget = MemoryBudget(
+                settings.MEDIA_FETCH_RANGE_MEMORY_BUDGET,
+            )
+        return _range_memory_budget
+
+
+def ranged_download_slots():
+    """Return the semaphore limiting the files this process downloads in ranges at once."""
+    global _ranged_download_slots
+    with _ranged_lock:
+        if _ranged_download_slots is None:
+            _ranged_download_slots = threading.BoundedSemaphore(
+                settings.MEDIA_FETCH_RANGED_FILE_CONCURRENCY,
+            )
+        return _ranged_download_slots
+
+
+_http_session = None
+
+
+def http_session():
+    """Return the keep-alive HTTP session shared by this worker process.
+
+    The connection pool is sized so every thread fetching media (or a byte
+    range of a large file) in parallel can keep its own connection to a
+    host open, and requests are
+    limited to the rate each media host can sustain (see rate_limit).
+    """
+    global _http_session
+    if _http_session is None:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=(
+                settings.MEDIA_FETCH_CONCURRENCY *
+                settings.MEDIA_FETCH_RANGE_CONCURRENCY
+            ),
+        )
+        _http_session = rate_limit.RateLimitedSession()
+        _http_session.mount('http://', adapter)
+        _http_session.mount('https://', adapter)
+    return _http_session
+
+
+def md5_digest_to_b64(digest):
+    # the TsvHttpData manifest expects the base64 encoded MD5, not the hex digest
+    return base64.b64encode(digest).decode()
+
+
+def stream_media_metadata(url, session=None, chunk_size=None):
+    """Download a media file and return its MediaInfo.
+
+    The response body is hashed chunk by chunk as it arrives, so only one
+    chunk of the file is ever held in memory regardless of the file size.
+    """
+    if session is None:
+        session = requests
+    if chunk_size is None:
+        chunk_size = settings.MEDIA_FETCH_CHUNK_SIZE
+
+    filesize = 0
+    md5 = hashlib.md5()
+    with session.get(url, stream=True) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            filesize += len(chunk)
+            md5.update(chunk)
+
+    return MediaInfo(
+        filesize,
+        md5_digest_to_b64(md5.digest()),
+        r.headers.get('ETag'),
+        r.headers.get('Last-Modified'),
+    )
+
+
+def media_info_from_headers(headers):
+    """Return the MediaInfo described by a set of response headers.
+
+    Returns None if the headers can't be trusted to describe the downloaded
+    bytes, e.g. when there's no usable checksum, the body is served with a
+    content encoding, or the ETag is from a multipart upload.
+    """
+    # the length and checksum would describe the encoded, not the decoded, body
+    if headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+
+    try:
+        filesize = int(headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+    etag = headers.get('ETag')
+    last_modified = headers.get('Last-Modified')
+
+    content_md5 = headers.get('Content-MD5')
+    if content_md5:
+        try:
+            digest = base64.b64decode(content_md5, validate=True)
+        except binascii.Error:
+            return None
+        if len(digest) != hashlib.md5().digest_size:
+            return None
+        return MediaInfo(filesize, md5_digest_to_b64(digest), etag, last_modified)
+
+    if not settings.MEDIA_METADATA_TRUST_ETAG or not etag:
+        return None
+
+    if etag.startswith('W/'):
+        return None
+    etag_md5 = etag.strip('"')
+    if not SINGLE_PART_ETAG.match(etag_md5):
+        return None
+
+    return MediaInfo(
+        filesize,
+        md5_digest_to_b64(bytes.fromhex(etag_md5)),
+        etag,
+        last_modified,
+    )
+
+
+def ranged_download_size(headers):
+    """Return the size of a file that can be downloaded in ranges, or None.
+
+    Only files of at least MEDIA_FETCH_RANGED_THRESHOLD bytes, served
+    without a content encoding by a host that accepts byte ranges, are
+    worth downloading in parallel ranges.
+    """
+    if not settings.MEDIA_FETCH_RANGED_DOWNLOADS:
+        return None
+    if headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return None
+    if headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    try:
+        filesize = int(headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+    if filesize < settings.MEDIA_FETCH_RANGED_THRESHOLD:
+        return None
+    return filesize
+
+
+def byte_ranges(filesize, range_size=None):
+    """Yield the inclusive (start, end) byte ranges covering a file."""
+    if range_size is None:
+        range_size = settings.MEDIA_FETCH_RANGE_SIZE
+    for start in range(0, filesize, range_size):
+        yield start, min(start + range_size, filesize) - 1
+
+
+def range_validator(headers):
+    """Return the If-Range validator that pins ranges to one file version."""
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def range_headers(start, end, validator=None):
+    headers = {
+        'Range': 'bytes={}-{}'.format(start, end),
+        'Accept-Encoding': 'identity',
+    }
+    if validator:
+        headers['If-Range'] = validator
+    return headers
+
+
+def check_range_response(status_code, headers, start, end, filesize, body):
+    """Raise RangeNotSatisfiable unless a response is exactly the range asked for.
+
+    Hosts that ignore the Range header (or whose file changed, failing the
+    If-Range) respond with the whole file instead.
+    """
+    if status_code != 206:
+        raise RangeNotSatisfiable('Expected 206 but got {}'.format(status_code))
+    if headers.get('Content-Encoding', 'identity') != 'identity':
+        raise RangeNotSatisfiable('Range was served with a content encoding')
+    content_range = CONTENT_RANGE.match(headers.get('Content-Range', ''))
+    if not content_range or tuple(map(int, content_range.groups())) != (start, end, filesize):
+        raise RangeNotSatisfiable(
+            'Unexpected Content-Range {}'.format(headers.get('Content-Range'))
+        )
+    if len(body) != end - start + 1:
+        raise RangeNotSatisfiable('Incomplete range {}-{}'.format(start, end))
+
+
+def fetch_range(url, start, end, filesize, validator, session):
+    r = session.get(url, headers=range_headers(start, end, validator))
+    if r.status_code != 416:
+        r.raise_for_status()
+    check_range_response(r.status_code, r.headers, start, end, filesize, r.content)
+    return r.content
+
+
+def ranged_media_metadata(url, filesize, headers, session=None):
+    """Download a large media file in parallel byte ranges and return its MediaInfo.
+
+    Up to MEDIA_FETCH_RANGE_CONCURRENCY ranges are downloaded at a time,
+    and fed into the MD5 in order as soon as each one is available, so the
+    hash is the same as that of a single stream download. `headers` are
+    those of a HEAD request for the file.
+
+    Only MEDIA_FETCH_RANGED_FILE_CONCURRENCY files are downloaded in ranges
+    at once in each process, and every range reserves its size from the
+    process's range_memory_budget() until it has been hashed.
+    """
+    if session is None:
+        session = requests
+
+    validator = range_validator(headers)
+    concurrency = settings.MEDIA_FETCH_RANGE_CONCURRENCY
+    budget = range_memory_budget()
+    md5 = hashlib.md5()
+
+    def hash_next(pending):
+        future, reserved = pending.popleft()
+        try:
+            md5.update(future.result())
+        finally:
+            budget.release(reserved)
+
+    with ranged_download_slots(), ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        try:
+            for start, end in byte_ranges(filesize):
+                size = end - start + 1
+                # hash the ranges already downloaded rather than wait for
+                # memory while holding them, which could deadlock threads
+                reserved = budget.try_acquire(size)
+                while not reserved and pending:
+                    hash_next(pending)
+                    reserved = budget.try_acquire(size)
+                if not reserved:
+                    reserved = budget.acquire(size)
+
+                pending.append((executor.submit(
+                    fetch_range, url, start, end, filesize, validator, session,
+                ), reserved))
+                if len(pending) >= concurrency:
+                    hash_next(pending)
+            while pending:
+                hash_next(pending)
+        finally:
+            for future, reserved in pending:
+                future.cancel()
+                budget.release(reserved)
+
+    return MediaInfo(
+        filesize,
+        md5_digest_to_b64(md5.digest()),
+        headers.get('ETag'),
+        headers.get('Last-Modified'),
+    )
+
+
+def resolve_media_metadata(url, session=None):
+    """Return the MediaInfo for a media URL.
+
+    Tries the response headers of a HEAD request first, and only downloads
+    the whole file when they don't provide a trustworthy checksum. Large
+    files are downloaded in parallel byte ranges where the host allows it.
+    """
+    if session is None:
+        session = requests
+
+    if settings.MEDIA_METADATA_HEAD_REQUESTS or settings.MEDIA_FETCH_RANGED_DOWNLOADS:
+        try:
+            r = session.head(url, allow_redirects=True)
+        except requests.RequestException:
+            r = None
+
+        if r is not None and r.ok:
+            if settings.MEDIA_METADATA_HEAD_REQUESTS:
+                metadata = media_info_from_headers(r.headers)
+                if metadata:
+                    return metadata
+
+            filesize = ranged_download_size(r.headers)
+            if filesize:
+                try:
+                    return ranged_media_metadata(r.url, filesize, r.headers, session)
+                except RangeNotSatisfiable:
+                    pass
+
+    return stream_media_metadata(url, session=session)
+
+
+def cache_fresh_after():
+    return timezone.now() - timedelta(seconds=settings.MEDIA_METADATA_CACHE_TTL)
+
+
+def cached_media_info(entry):
+    return MediaInfo(entry.filesize, entry.hash, entry.etag, entry.last_modified)
+
+
+def lookup_cached_media_metadata(urls):
+    """Return a dict of url -> MediaMetadataCache for cached, fresh URLs.
+
+    Entries that are older than MEDIA_METADATA_CACHE_TTL are left out, so
+    that they get revalidated by refresh_media_metadata().
+    """
+    cached = {
+        entry.url: entry
+        for entry in MediaMetadataCache.objects.filter(
+            url__in=urls,
+            validated__gte=cache_fresh_after(),
+        )
+    }
+    if cached:
+        MediaMetadataCache.objects.filter(
+            url__in=cached.keys(),
+        ).update(last_used=timezone.now())
+    return cached
+
+
+def conditional_headers(entry):
+    headers = {}
+    if entry.etag:
+        headers['If-None-Match'] = entry.etag
+    if entry.last_modified:
+        headers['If-Modified-Since'] = entry.last_modified
+    return headers
+
+
+def is_revalidated(entry, status_code, headers):
+    if status_code == 304:
+        return True
+    # not every host honours conditional HEAD requests
+    return (
+        200 <= status_code < 400 and
+        bool(entry.etag) and
+        headers.get('ETag') == entry.etag and
+        headers.get('Last-Modified') == entry.last_modified
+    )
+
+
+def revalidate_media_metadata(entry, session=None):
+    """Check whether a cached entry still describes the file at its URL."""
+    if session is None:
+        session = requests
+
+    headers = conditional_headers(entry)
+    if not headers:
+        return False
+
+    r = session.head(entry.url, headers=headers, allow_redirects=True)
+    return is_revalidated(entry, r.status_code, r.headers)
+
+
+def refresh_media_metadata(url, stale_entry=None, session=None):
+    """Return the MediaInfo for a URL that has a stale or no cache entry.
+
+    A stale entry is revalidated with its ETag / Last-Modified before the
+    file is fetched again. This only makes HTTP requests and never touches
+    the database, so it's safe to call from a thread pool.
+    """
+    if stale_entry:
+        try:
+            if revalidate_media_metadata(stale_entry, session=session):
+                return cached_media_info(stale_entry)
+        except requests.RequestException:
+            pass
+
+    return resolve_media_metadata(url, session=session)
+
+
+def update_media_metadata_cache(metadata):
+    """Store a dict of url -> MediaInfo that has just been validated."""
+    now = timezone.now()
+    existing = MediaMetadataCache.objects.in_bulk(
+        list(metadata.keys()),
+        field_name='url',
+    )
+    updated_entries = []
+    new_entries = []
+    for url, info in metadata.items():
+        entry = existing.get(url)
+        if entry:
+            updated_entries.append(entry)
+        else:
+            entry = MediaMetadataCache(url=url)
+            new_entries.append(entry)
+        entry.filesize = info.filesize
+        entry.hash = info.hash
+        entry.etag = info.etag
+        entry.last_modified = info.last_modified
+        entry.validated = now
+        entry.last_used = now
+
+    MediaMetadataCache.objects.bulk_update(
+        updated_entries,
+        ['filesize', 'hash', 'etag', 'last_modified', 'validated', 'last_used'],
+    )
+    # another worker may have cached the same URL in the meantime
+    MediaMetadataCache.objects.bulk_create(new_entries, ignore_conflicts=True)
+
+
+def fetch_cached_media_metadata(url, session=None):
+    """Return the MediaInfo for a media URL, using the cache where possible."""
+    cached = lookup_cached_media_metadata([url])
+    if url in cached:
+        return cached_media_info(cached[url])
+
+    metadata = refresh_media_metadata(
+        url,
+        stale_entry=MediaMetadataCache.objects.filter(url=url).first(),
+        session=session,
+    )
+    update_media_metadata_cache({url: metadata})
+    return metadata
+
+
+def evict_media_metadata_cache(max_entries=None):
+    """Delete the least recently used entries beyond the cache size limit.
+
+    Entries are ranked by last_used and then id, so that entries used at
+    the same time as the last one kept aren't deleted along with the rest.
+    The (last_used, id) of the last entry to evict is found first, and the
+    entries up to it are deleted in batches in index order. Entries used
+    by an export in the meantime are newer than that key, so they're kept.
+    """
+    if max_entries is None:
+        max_entries = settings.MEDIA_METADATA_CACHE_MAX_ENTRIES
+
+    excess = MediaMetadataCache.objects.count() - max_entries
+    if excess <= 0:
+        return 0
+
+    last_used, last_id = MediaMetadataCache.objects.order_by(
+        'last_used',
+        'id',
+    ).values_list('last_used', 'id')[excess - 1]
+    evictable = MediaMetadataCache.objects.filter(
+        last_used__lte=last_used,
+    ).exclude(
+        last_used=last_used,
+        id__gt=last_id,
+    ).order_by('last_used', 'id')
+
+    deleted = 0
+    batch_size = settings.EXPORT_QUERY_CHUNK_SIZE
+    while True:
+        batch_ids = list(evictable.values_list('id', flat=True)[:batch_size])
+        if not batch_ids:
+            return deleted
+        batch_deleted, _ = MediaMetadataCache.objects.filter(
+            pk__in=batch_ids,
+        ).delete()
+        deleted += batch_deleted
@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+from . import media_fetch
+from . import rate_limit
+
+# aiohttp is only needed when MEDIA_FETCH_ENGINE is set to 'asyncio'
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncEngineUnavailable(Exception):
+    pass
+
+
+class MemoryBudget:
+    """The asyncio equivalent of media_fetch.MemoryBudget, for one event loop."""
+
+    def __init__(self, size):
+        self.size = size
+        self.reserved = 0
+        self.released = asyncio.Event()
+
+    def try_acquire(self, size):
+        size = min(size, self.size)
+        if self.reserved + size > self.size:
+            return 0
+        self.reserved += size
+        return size
+
+    async def acquire(self, size):
+        reserved = self.try_acquire(size)
+        while not reserved:
+            self.released.clear()
+            await self.released.wait()
+            reserved = self.try_acquire(size)
+        return reserved
+
+    def release(self, size):
+        self.reserved -= size
+        self.released.set()
+
+
+async def head(session, url):
+    """Return the final URL and headers of a HEAD request, or None on failure."""
+    try:
+        async with session.head(url, allow_redirects=True) as r:
+            if r.status >= 400:
+                return None
+            return str(r.url), r.headers
+    except aiohttp.ClientError:
+        return None
+
+
+async def stream_media_metadata(session, url):
+    filesize = 0
+    md5 = hashlib.md5()
+    async with session.get(url) as r:
+        r.raise_for_status()
+        async for chunk in r.content.iter_chunked(settings.MEDIA_FETCH_CHUNK_SIZE):
+            filesize += len(chunk)
+            md5.update(chunk)
+
+        return media_fetch.MediaInfo(
+            filesize,
+            media_fetch.md5_digest_to_b64(md5.digest()),
+            r.headers.get('ETag'),
+            r.headers.get('Last-Modified'),
+        )
+
+
+async def fetch_range(session, url, start, end, filesize, validator):
+    async with session.get(
+        url,
+        headers=media_fetch.range_headers(start, end, validator),
+        auto_decompress=False,
+    ) as r:
+        if r.status != 416:
+            r.raise_for_status()
+        body = await r.read()
+        media_fetch.check_range_response(r.status, r.headers, start, end, filesize, body)
+        return body
+
+
+async def ranged_media_metadata(session, url, filesize, headers, budget, ranged_files):
+    """The asyncio equivalent of media_fetch.ranged_media_metadata().
+
+    budget is the MemoryBudget and ranged_files the semaphore of files
+    downloaded in ranges at once shared by the whole batch.
+    """
+    validator = media_fetch.range_validator(headers)
+    concurrency = settings.MEDIA_FETCH_RANGE_CONCURRENCY
+    md5 = hashlib.md5()
+    pending = deque()
+
+    async def hash_next():
+        task, reserved = pending.popleft()
+        try:
+            md5.update(await task)
+        finally:
+            budget.release(reserved)
+
+    async with ranged_files:
+        try:
+            for start, end in media_fetch.byte_ranges(filesize):
+                size = end - start + 1
+                # hash the ranges already downloaded rather than wait for
+                # memory while holding them, which could deadlock downloads
+                reserved = budget.try_acquire(size)
+                while not reserved and pending:
+                    await hash_next()
+                    reserved = budget.try_acquire(size)
+                if not reserved:
+                    reserved = await budget.acquire(size)
+
+                pending.append((asyncio.ensure_future(
+                    fetch_range(session, url, start, end, filesize, validator),
+                ), reserved))
+                if len(pending) >= concurrency:
+                    await hash_next()
+            while pending:
+                await hash_next()
+        finally:
+            for task, reserved in pending:
+                task.cancel()
+                budget.release(reserved)
+
+    return media_fetch.MediaInfo(
+        filesize,
+        media_fetch.md5_digest_to_b64(md5.digest()),
+        headers.get('ETag'),
+        headers.get('Last-Modified'),
+    )
+
+
+async def refresh_media_metadata(session, url, budget, ranged_files, stale_entry=None):
+    """The asyncio equivalent of media_fetch.refresh_media_metadata()."""
+    if stale_entry:
+        headers = media_fetch.conditional_headers(stale_entry)
+        if headers:
+            try:
+                async with session.head(
+                    url,
+                    headers=headers,
+                    allow_redirects=True,
+                ) as r:
+                    if media_fetch.is_revalidated(stale_entry, r.status, r.headers):
+                        return media_fetch.cached_media_info(stale_entry)
+            except aiohttp.ClientError:
+                pass
+
+    if settings.MEDIA_METADATA_HEAD_REQUESTS or settings.MEDIA_FETCH_RANGED_DOWNLOADS:
+        response = await head(session, url)
+        if response:
+            final_url, headers = response
+            if settings.MEDIA_METADATA_HEAD_REQUESTS:
+                metadata = media_fetch.media_info_from_headers(headers)
+                if metadata:
+                    return metadata
+
+            filesize = media_fetch.ranged_download_size(headers)
+            if filesize:
+                try:
+                    return await ranged_media_metadata(
+                        session,
+                        final_url,
+                        filesize,
+                        headers,
+                        budget,
+                        ranged_files,
+                    )
+                except media_fetch.RangeNotSatisfiable:
+                    pass
+
+    return await stream_media_metadata(session, url)
+
+
+async def on_request_start(session, context, params):
+    loop = asyncio.get_running_loop()
+    # the rate limiter talks to Redis, so keep it off the event loop
+    wait = await loop.run_in_executor(None, rate_limit.reserve, str(params.url))
+    if wait > 0:
+        await asyncio.sleep(wait)
+    context.start = loop.time()
+
+
+async def on_request_end(session, context, params):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(
+        None,
+        rate_limit.record_response,
+        str(params.url),
+        params.response.status,
+        loop.time() - context.start,
+        params.response.headers.get('Retry-After'),
+    )
+
+
+async def on_request_exception(session, context, params):
+    if isinstance(params.exception, (asyncio.TimeoutError, aiohttp.ClientConnectionError)):
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            rate_limit.record,
+            str(params.url),
+            True,
+        )
+
+
+def rate_limit_trace_config():
+    """Hook the shared per-host rate limiter into an aiohttp ClientSession."""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+async def fetch_all(jobs):
+    global_limit = asyncio.Semaphore(settings.MEDIA_FETCH_ASYNC_CONCURRENCY)
+    host_limits = defaultdict(
+        lambda: asyncio.Semaphore(settings.MEDIA_FETCH_ASYNC_PER_HOST_CONCURRENCY)
+    )
+    # ranges are read into memory whole, so their total size is limited
+    range_budget = MemoryBudget(settings.MEDIA_FETCH_RANGE_MEMORY_BUDGET)
+    ranged_files = asyncio.Semaphore(settings.MEDIA_FETCH_RANGED_FILE_CONCURRENCY)
+    results = [None] * len(jobs)
+
+    connector = aiohttp.TCPConnector(
+        limit=settings.MEDIA_FETCH_ASYNC_CONCURRENCY,
+        limit_per_host=settings.MEDIA_FETCH_ASYNC_PER_HOST_CONCURRENCY,
+    )
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        trace_configs=[rate_limit_trace_config()],
+    ) as session:
+
+        async def fetch(i, url, stale_entry):
+            # wait for the host's limit first, so that a slow host can't tie
+            # up the global slots while other hosts have capacity
+            async with host_limits[urlparse(url).netloc]:
+                async with global_limit:
+                    try:
+                        results[i] = (
+                            await refresh_media_metadata(
+                                session,
+                                url,
+                                range_budget,
+                                ranged_files,
+                                stale_entry,
+                            ),
+                            None,
+                        )
+                    except Exception as e:
+                        results[i] = (None, e)
+
+        await asyncio.gather(*(
+            fetch(i, url, stale_entry)
+            for i, (url, stale_entry) in enumerate(jobs)
+        ))
+
+    return results
+
+
+def fetch_media_metadata(jobs):
+    """Fetch the MediaInfo for many URLs concurrently on an asyncio loop.
+
+    Takes a list of (url, stale cache entry or None) tuples and returns a
+    list of (MediaInfo, None) or (None, exception) tuples in the same order.
+    Concurrency is bounded globally by MEDIA_FETCH_ASYNC_CONCURRENCY and
+    for each host by MEDIA_FETCH_ASYNC_PER_HOST_CONCURRENCY, and requests
+    are limited to each host's shared rate (see rate_limit). Byte ranges of
+    large files are limited as for the threads engine, for the whole batch.
+    """
+    if aiohttp is None:
+        raise AsyncEngineUnavailable(
+            'Please install aiohttp to use the asyncio media fetch engine'
+        )
+    return asyncio.run(fetch_all(jobs))
@@ -1,9 +1,5 @@
-from azure.storage.blob import BlockBlobService, BlobPermissions
-import json
 import os
-import tempfile
 import requests
-from datetime import datetime, timedelta
 
 import django
 # set the default Django settings module for the 'celery' program.
@@ -13,8 +9,8 @@ django.setup()
 from django.conf import settings
 
 from exports.models import MLSubjectAssistantExport
-from .zooniverse_auth import SocialPanoptes
-from panoptes_client import SubjectSet
+from . import azure_blobs
+from . import manifests
 
 
 def ml_subject_assistant_export_to_microsoft_pt1_get_subjects_data(
@@ -24,104 +20,64 @@ def ml_subject_assistant_export_to_microsoft_pt1_get_subjects_data(
     print('[Subject Assistant] Exporting to Microsoft 1/4: get Subjects')
 
     export = MLSubjectAssistantExport.objects.get(pk=export_id)
-    # Keeps track of all data items that needs to written into a Microsoft-friendly JSON format.
-    data = []
+    # The data items are only generated (from the Subject Set's snapshot)
+    # while the export files are being written.
+    return manifests.subject_set_snapshot(access_token, export.subject_set_id)
 
-    # Retrieve all Subjects from a Subject Set
-    with SocialPanoptes(bearer_token=access_token) as p:
-        subject_set = SubjectSet.find(export.subject_set_id)
 
-        # Process each Subject
-        for subject in subject_set.subjects:
+def azure_blob_service():
+    return azure_blobs.block_blob_service(
+        settings.SUBJECT_ASSISTANT_AZURE_ACCOUNT_NAME,
+        settings.SUBJECT_ASSISTANT_AZURE_ACCOUNT_KEY,
+    )
 
-            # Create a data item for each image URL in the Subject
-            for frame_id, location in enumerate(subject.locations):
-                image_url = list(location.values())[0]
 
-                subject_information = {
-                    'project_id': str(subject_set.links.project.id),
-                    'subject_set_id': str(export.subject_set_id),
-                    'subject_id': str(subject.id),
-                    'frame_id': str(frame_id)
-                }
+def ml_subject_assistant_export_to_microsoft_pt2_upload_file(data, target_filename, backup_f=None):
 
-                item = []
-                item.append(image_url)
-                # The subject's JSON information is stored as a string. Yes, really.
-                item.append(json.dumps(subject_information))
+    print('[Subject Assistant] Exporting to Microsoft 2/4: upload file to Azure')
 
-                data.append(item)
-
-    return data
-
-
-def ml_subject_assistant_export_to_microsoft_pt2_create_file(export_id, data, target_filename):
-
-    print('[Subject Assistant] Exporting to Microsoft 2/4: create file')
-
-    export = MLSubjectAssistantExport.objects.get(pk=export_id)
-
-    # Write the data to a file
-    source_filepath = ''
     try:
-        # First create a temporary JSON file
-        with tempfile.NamedTemporaryFile(
-            'w+',
-            encoding='utf-8',
-            dir=settings.TMP_STORAGE_PATH,
-            delete=False,
-        ) as out_f:
-            json.dump(data, out_f)
-            out_f.flush()
-            source_filepath = out_f.name
-
-        return source_filepath
+        # data() generates the data items again each time it's called. They
+        # are hashed (and streamed into the backup file) first, and only
+        # streamed into an Azure blob if there isn't an identical file on
+        # Azure already.
+        return azure_blobs.upload_deduplicated_blob(
+            azure_blob_service(),
+            settings.SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME,
+            target_filename,
+            lambda out_f: manifests.write_manifest(out_f, data()),
+            backup_f,
+        )
 
     except Exception as err:
-
         print('[ERROR] ', err)
+        raise err
 
-        # Only cleanup the temporary file on error; otherwise it'll be cleaned up in the main function.
-        try:
-            if len(source_filepath) > 0:
-                os.unlink(source_filepath)
-        except OSError:
-            pass
 
-        raise err
+def ml_subject_assistant_export_to_microsoft_pt2_upload_shards(snapshot, target_filename, backup_f=None):
+    """Upload the manifest in shards of SUBJECT_ASSISTANT_SHARD_SIZE items, in parallel.
 
+    Returns the blob name of each shard.
+    """
+    return manifests.upload_manifest_shards(
+        snapshot,
+        target_filename,
+        ml_subject_assistant_export_to_microsoft_pt2_upload_file,
+        backup_f,
+    )
 
-def ml_subject_assistant_export_to_microsoft_pt3_create_shareable_azure_blob(
-    source_filepath,
-    target_filename,
-):
+
+def ml_subject_assistant_export_to_microsoft_pt3_create_shareable_azure_blob(blob_name):
 
     print('[Subject Assistant] Exporting to Microsoft 3/4: create shareable Azure blob')
 
     shareable_file_url = ''
 
     try:
-        block_blob_service = BlockBlobService(
-            account_name=settings.SUBJECT_ASSISTANT_AZURE_ACCOUNT_NAME, account_key=settings.SUBJECT_ASSISTANT_AZURE_ACCOUNT_KEY)
-
-        created_blob = block_blob_service.create_blob_from_path(
-            settings.SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME, target_filename, source_filepath)
-
-        blob_permissions = BlobPermissions(read=True)
-        sas_expiry = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d')
-
-        generated_sas = block_blob_service.generate_blob_shared_access_signature(
-            container_name=settings.SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME,
-            blob_name=target_filename,
-            permission=blob_permissions,
-            expiry=sas_expiry
-        )
-
-        shareable_file_url = 'https://{}.blob.core.windows.net/{}/{}?{}'.format(
-            settings.SUBJECT_ASSISTANT_AZURE_ACCOUNT_NAME,
+        shareable_file_url = azure_blobs.shareable_blob_url(
+            azure_blob_service(),
             settings.SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME,
-            target_filename,
-            generated_sas
+            blob_name,
         )
 
     except Exception as err:
@@ -131,6 +87,35 @@ def ml_subject_assistant_export_to_microsoft_pt3_create_shareable_azure_blob(
     return shareable_file_url
 
 
+def refresh_shareable_url(export):
+    """Replace an export's expiring shareable URL with a newly signed one.
+
+    The blob that was uploaded for the export is reused as is, so this
+    doesn't need the export to be run again.
+    """
+    print('[Subject Assistant] Refreshing shareable Azure blob URL for export {}'.format(export.id))
+
+    blob_names = [
+        url and azure_blobs.shareable_url_blob_name(
+            url,
+            settings.SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME,
+        )
+        for url in export.shard_azure_urls or [export.azure_url]
+    ]
+    if not all(blob_names):
+        raise ValueError('Export {} has no Azure blob to share'.format(export.id))
+
+    shareable_file_urls = [
+        ml_subject_assistant_export_to_microsoft_pt3_create_shareable_azure_blob(blob_name)
+        for blob_name in blob_names
+    ]
+    export.azure_url = shareable_file_urls[0]
+    if export.shard_azure_urls:
+        export.shard_azure_urls = shareable_file_urls
+    export.save(update_fields=['azure_url', 'shard_azure_urls', 'modified'])
+    return export.azure_url
+
+
 def ml_subject_assistant_export_to_microsoft_pt4_make_ml_request(shareable_file_url):
 
     print('[Subject Assistant] Exporting to Microsoft 4/4: make request to Microsoft')
@@ -181,3 +166,12 @@ def ml_subject_assistant_export_to_microsoft_pt4_make_ml_request(shareable_file_
 
     return ml_task_uuid
 
+
+def ml_subject_assistant_export_to_microsoft_pt4_make_ml_requests(shareable_file_urls, ml_task_uuids, on_submitted):
+    """Submit an ML task for each shard of the manifest without one yet, in parallel."""
+    return manifests.submit_manifest_shards(
+        ml_subject_assistant_export_to_microsoft_pt4_make_ml_request,
+        shareable_file_urls,
+        ml_task_uuids,
+        on_submitted,
+    )
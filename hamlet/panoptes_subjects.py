@@ -0,0 +1,63 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+def resolve_links(resource, *link_names):
+    """Return a dict of link name -> linked id for a Panoptes resource.
+
+    panoptes_client builds a new linked object every time a link is read,
+    so the ids are looked up once rather than once per item.
+    """
+    return {
+        link_name: str(getattr(resource.links, link_name).id)
+        for link_name in link_names
+    }
+
+
+def location_urls(subject):
+    """Return the URL of each location (frame) of a raw Panoptes subject."""
+    return [list(location.values())[0] for location in subject['locations']]
+
+
+def fetch_subject_page(panoptes, subject_set_id, page):
+    response, _ = panoptes.get(
+        '/subjects',
+        params={
+            'subject_set_id': subject_set_id,
+            'page': page,
+            'page_size': settings.PANOPTES_PAGE_SIZE,
+        },
+    )
+    return response
+
+
+def iter_subject_pages(panoptes, subject_set_id):
+    """Yield the raw subjects of a Subject Set, one Panoptes API page at a time.
+
+    Fetching /subjects directly returns each subject's locations with the
+    page, rather than having to resolve every set member's subject link.
+    The first page tells us the page count, after which up to
+    PANOPTES_PAGE_CONCURRENCY pages are fetched in parallel. Pages are
+    still yielded in order, as soon as each one is available, and only a
+    bounded number of pages are fetched ahead of the consumer.
+    """
+    response = fetch_subject_page(panoptes, subject_set_id, 1)
+    yield response['subjects']
+    page_count = response['meta']['subjects'].get('page_count') or 1
+
+    concurrency = settings.PANOPTES_PAGE_CONCURRENCY
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        next_page = 2
+        while pending or next_page <= page_count:
+            while next_page <= page_count and len(pending) < concurrency * 2:
+                pending.append(executor.submit(
+                    fetch_subject_page,
+                    panoptes,
+                    subject_set_id,
+                    next_page,
+                ))
+                next_page += 1
+            yield pending.popleft().result()['subjects']
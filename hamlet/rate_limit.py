@@ -0,0 +1,231 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import redis
+import requests
+
+from django.conf import settings
+from django.utils import timezone
+
+# responses that mean the media host is overloaded and we should slow down
+CONGESTION_STATUSES = {429, 502, 503, 504}
+
+# Reserves a request slot in a host's token bucket and returns the number of
+# seconds to wait before making the request. Tokens are allowed to go
+# negative, so waiting callers are queued in order rather than polling.
+RESERVE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'rate', 'tokens', 'updated', 'blocked_until')
+local rate = tonumber(state[1]) or tonumber(ARGV[1])
+local tokens = tonumber(state[2]) or rate
+local updated = tonumber(state[3]) or now
+local blocked_until = tonumber(state[4]) or 0
+
+tokens = math.min(math.max(rate, 1), tokens + (now - updated) * rate) - 1
+local wait = 0
+if tokens < 0 then
+    wait = -tokens / rate
+end
+if blocked_until > now + wait then
+    wait = blocked_until - now
+end
+
+redis.call('HMSET', KEYS[1], 'rate', rate, 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return tostring(wait)
+"""
+
+# Adjusts a host's request rate from the outcome of a request: additive
+# increase for every fast successful response, multiplicative decrease (at
+# most once per DECREASE_INTERVAL) for congestion, and blocking every worker
+# for the host's Retry-After.
+RECORD_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'rate', 'decreased_at', 'blocked_until')
+local rate = tonumber(state[1]) or tonumber(ARGV[3])
+local decreased_at = tonumber(state[2]) or 0
+local blocked_until = tonumber(state[3]) or 0
+local min_rate = tonumber(ARGV[4])
+local max_rate = tonumber(ARGV[5])
+
+if ARGV[1] == 'ok' then
+    rate = math.min(max_rate, rate + tonumber(ARGV[6]) / rate)
+else
+    if now - decreased_at >= tonumber(ARGV[8]) then
+        rate = math.max(min_rate, rate * tonumber(ARGV[7]))
+        redis.call('HSET', KEYS[1], 'decreased_at', now)
+    end
+    local retry_after = tonumber(ARGV[2])
+    if retry_after > 0 and now + retry_after > blocked_until then
+        redis.call('HSET', KEYS[1], 'blocked_until', now + retry_after)
+    end
+end
+
+redis.call('HSET', KEYS[1], 'rate', rate)
+redis.call('EXPIRE', KEYS[1], ARGV[9])
+return tostring(rate)
+"""
+
+# forget about hosts that haven't been fetched from for a day
+HOST_STATE_TTL = 24 * 60 * 60
+
+
+_redis = None
+_reserve_script = None
+_record_script = None
+
+
+def redis_client():
+    global _redis, _reserve_script, _record_script
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.REDIS_URI)
+        _reserve_script = _redis.register_script(RESERVE_SCRIPT)
+        _record_script = _redis.register_script(RECORD_SCRIPT)
+    return _redis
+
+
+def host_key(url):
+    return 'hamlet:media-host:{}'.format(urlparse(url).netloc.lower())
+
+
+def reserve(url):
+    """Reserve a request to the host of `url` in its shared token bucket.
+
+    Returns the number of seconds the caller must wait before making the
+    request. If Redis is unavailable requests aren't rate limited at all,
+    rather than failing the export.
+    """
+    if not settings.MEDIA_HOST_RATE_LIMIT:
+        return 0
+    try:
+        redis_client()
+        return float(_reserve_script(
+            keys=[host_key(url)],
+            args=[settings.MEDIA_HOST_INITIAL_RATE, HOST_STATE_TTL],
+        ))
+    except redis.RedisError:
+        return 0
+
+
+def acquire(url):
+    """Block until a request may be made to the host of `url`."""
+    wait = reserve(url)
+    if wait > 0:
+        time.sleep(wait)
+
+
+def parse_retry_after(value):
+    """Return the seconds to wait given by a Retry-After header, or 0."""
+    if not value:
+        return 0
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    if retry_at is None:
+        return 0
+    if timezone.is_naive(retry_at):
+        retry_at = timezone.make_aware(retry_at, timezone.utc)
+    return max(0, (retry_at - timezone.now()).total_seconds())
+
+
+def is_congested(status, elapsed):
+    return (
+        status in CONGESTION_STATUSES or
+        elapsed > settings.MEDIA_HOST_SLOW_RESPONSE
+    )
+
+
+def record(url, congested, retry_after=0):
+    """Feed the outcome of a request to the host of `url` back into its rate."""
+    if not settings.MEDIA_HOST_RATE_LIMIT:
+        return
+    try:
+        redis_client()
+        _record_script(
+            keys=[host_key(url)],
+            args=[
+                'congested' if congested else 'ok',
+                retry_after,
+                settings.MEDIA_HOST_INITIAL_RATE,
+                settings.MEDIA_HOST_MIN_RATE,
+                settings.MEDIA_HOST_MAX_RATE,
+                settings.MEDIA_HOST_RATE_INCREASE,
+                settings.MEDIA_HOST_RATE_DECREASE,
+                settings.MEDIA_HOST_RATE_DECREASE_INTERVAL,
+                HOST_STATE_TTL,
+            ],
+        )
+    except redis.RedisError:
+        pass
+
+
+def record_response(url, status, elapsed, retry_after_header=None):
+    record(
+        url,
+        is_congested(status, elapsed),
+        retry_after=parse_retry_after(retry_after_header),
+    )
+
+
+class RateLimitedSession(requests.Session):
+    """A requests Session that waits for the shared per-host rate limit.
+
+    Every request (including each redirect) takes a token from its host's
+    bucket before being sent, and the status and time to the response
+    headers adjust the host's rate for all workers.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.hooks['response'].append(self.record_outcome)
+
+    def send(self, request, **kwargs):
+        acquire(request.url)
+        try:
+            return super().send(request, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            record(request.url, True)
+            raise
+
+    @staticmethod
+    def record_outcome(response, **kwargs):
+        record_response(
+            response.url,
+            response.status_code,
+            response.elapsed.total_seconds(),
+            response.headers.get('Retry-After'),
+        )
+
+
+def exception_retry_after(e):
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(e, 'headers', None)
+    if not headers:
+        return 0
+    return parse_retry_after(headers.get('Retry-After'))
+
+
+def retry_countdown(retries, exc=None):
+    """Return the countdown before retrying a failed media fetch task.
+
+    Exponential backoff with full jitter, so that tasks which failed
+    together don't all retry at the same moment, but never sooner than the
+    Retry-After given by the media host.
+    """
+    backoff = min(
+        settings.MEDIA_FETCH_RETRY_BACKOFF_MAX,
+        settings.MEDIA_FETCH_RETRY_BACKOFF * 2 ** retries,
+    )
+    countdown = random.uniform(0, backoff)
+    if exc is not None:
+        countdown = max(countdown, exception_retry_after(exc))
+    return countdown
@@ -202,19 +202,136 @@ TMP_STORAGE_PATH = os.environ.get(
     os.path.join(BASE_DIR, 'tmp'),
 )
 
+# Media files are hashed in chunks of this many bytes as they are downloaded
+MEDIA_FETCH_CHUNK_SIZE = int(os.environ.get('MEDIA_FETCH_CHUNK_SIZE', 1024 * 1024))
+
+# Take the filesize and MD5 from the Content-Length and Content-MD5 / ETag
+# headers of a HEAD request, falling back to downloading the file if needed.
+# Disable MEDIA_METADATA_TRUST_ETAG for hosts whose ETags aren't MD5s
+# (e.g. S3 buckets using SSE-KMS encryption).
+MEDIA_METADATA_HEAD_REQUESTS = os.environ.get('MEDIA_METADATA_HEAD_REQUESTS', 'True').lower() == 'true'
+MEDIA_METADATA_TRUST_ETAG = os.environ.get('MEDIA_METADATA_TRUST_ETAG', 'True').lower() == 'true'
+
+# Media metadata is cached by URL across exports. Entries older than the TTL
+# (in seconds) are revalidated against the media host before being reused,
+# and the least recently used entries beyond MAX_ENTRIES are evicted every hour.
+MEDIA_METADATA_CACHE_TTL = int(os.environ.get('MEDIA_METADATA_CACHE_TTL', 7 * 24 * 60 * 60))
+MEDIA_METADATA_CACHE_MAX_ENTRIES = int(os.environ.get('MEDIA_METADATA_CACHE_MAX_ENTRIES', 5000000))
+
+# Media metadata is fetched in tasks of BATCH_SIZE files each, with up to
+# CONCURRENCY files being fetched at a time in each task.
+MEDIA_FETCH_BATCH_SIZE = int(os.environ.get('MEDIA_FETCH_BATCH_SIZE', 100))
+MEDIA_FETCH_CONCURRENCY = int(os.environ.get('MEDIA_FETCH_CONCURRENCY', 8))
+
+# Set MEDIA_FETCH_ENGINE to 'asyncio' to fetch media metadata with aiohttp
+# instead of a thread pool, keeping many more downloads in flight per task.
+MEDIA_FETCH_ENGINE = os.environ.get('MEDIA_FETCH_ENGINE', 'threads')
+MEDIA_FETCH_ASYNC_BATCH_SIZE = int(os.environ.get('MEDIA_FETCH_ASYNC_BATCH_SIZE', 2000))
+MEDIA_FETCH_ASYNC_CONCURRENCY = int(os.environ.get('MEDIA_FETCH_ASYNC_CONCURRENCY', 200))
+MEDIA_FETCH_ASYNC_PER_HOST_CONCURRENCY = int(os.environ.get('MEDIA_FETCH_ASYNC_PER_HOST_CONCURRENCY', 50))
+
+# Files of at least RANGED_THRESHOLD bytes are downloaded in byte ranges of
+# RANGE_SIZE, RANGE_CONCURRENCY at a time, if the host supports it.
+MEDIA_FETCH_RANGED_DOWNLOADS = os.environ.get('MEDIA_FETCH_RANGED_DOWNLOADS', 'True').lower() == 'true'
+MEDIA_FETCH_RANGED_THRESHOLD = int(os.environ.get('MEDIA_FETCH_RANGED_THRESHOLD', 64 * 1024 * 1024))
+MEDIA_FETCH_RANGE_SIZE = int(os.environ.get('MEDIA_FETCH_RANGE_SIZE', 8 * 1024 * 1024))
+MEDIA_FETCH_RANGE_CONCURRENCY = int(os.environ.get('MEDIA_FETCH_RANGE_CONCURRENCY', 8))
+# Each range is held in memory until it's hashed, so at most RANGED_FILE_CONCURRENCY
+# files are downloaded in ranges at once, and ranges of no more than
+# RANGE_MEMORY_BUDGET bytes in total are in flight, in each worker process. Keep
+# the budget times the number of worker processes (CELERY_WORKER_CONCURRENCY in
+# start_worker.sh, 4 by default) well under the worker's memory limit (1000Mi in
+# production).
+MEDIA_FETCH_RANGED_FILE_CONCURRENCY = int(os.environ.get('MEDIA_FETCH_RANGED_FILE_CONCURRENCY', 2))
+MEDIA_FETCH_RANGE_MEMORY_BUDGET = int(os.environ.get('MEDIA_FETCH_RANGE_MEMORY_BUDGET', 32 * 1024 * 1024))
+
+# Requests to each media host are rate limited across all workers by a token
+# bucket in Redis. The rate (requests per second) starts at INITIAL_RATE,
+# grows by about RATE_INCREASE every second while responses are fast, and is
+# multiplied by RATE_DECREASE (at most once per DECREASE_INTERVAL seconds)
+# when the host responds with 429/5xx or takes longer than SLOW_RESPONSE
+# seconds to respond.
+MEDIA_HOST_RATE_LIMIT = os.environ.get('MEDIA_HOST_RATE_LIMIT', 'True').lower() == 'true'
+MEDIA_HOST_INITIAL_RATE = float(os.environ.get('MEDIA_HOST_INITIAL_RATE', 20))
+MEDIA_HOST_MIN_RATE = float(os.environ.get('MEDIA_HOST_MIN_RATE', 1))
+MEDIA_HOST_MAX_RATE = float(os.environ.get('MEDIA_HOST_MAX_RATE', 1000))
+MEDIA_HOST_RATE_INCREASE = float(os.environ.get('MEDIA_HOST_RATE_INCREASE', 1))
+MEDIA_HOST_RATE_DECREASE = float(os.environ.get('MEDIA_HOST_RATE_DECREASE', 0.5))
+MEDIA_HOST_RATE_DECREASE_INTERVAL = float(os.environ.get('MEDIA_HOST_RATE_DECREASE_INTERVAL', 1))
+MEDIA_HOST_SLOW_RESPONSE = float(os.environ.get('MEDIA_HOST_SLOW_RESPONSE', 5))
+
+# Failed media fetches are retried after a random delay of up to BACKOFF
+# seconds, doubling with every retry up to BACKOFF_MAX
+MEDIA_FETCH_RETRY_BACKOFF = float(os.environ.get('MEDIA_FETCH_RETRY_BACKOFF', 10))
+MEDIA_FETCH_RETRY_BACKOFF_MAX = float(os.environ.get('MEDIA_FETCH_RETRY_BACKOFF_MAX', 600))
+
+# Reuse the metadata of unchanged subject locations from the subject set's
+# previous complete export, and only fetch new or changed locations
+SUBJECT_SET_EXPORT_INCREMENTAL = os.environ.get('SUBJECT_SET_EXPORT_INCREMENTAL', 'True').lower() == 'true'
+
+# Running subject set exports can only be resumed once they've made no
+# progress for this many seconds
+SUBJECT_SET_EXPORT_STALE_AFTER = int(os.environ.get('SUBJECT_SET_EXPORT_STALE_AFTER', 60 * 60))
+
+# The subject locations of a subject set are enumerated from Panoptes into a
+# snapshot shared by every type of export. Snapshots older than MAX_AGE (in
+# seconds) are brought up to date before being used.
+SUBJECT_SET_SNAPSHOT_MAX_AGE = int(os.environ.get('SUBJECT_SET_SNAPSHOT_MAX_AGE', 60 * 60))
+# A refresh that hasn't committed a page for REFRESH_TIMEOUT seconds is taken
+# over by the next task that needs the snapshot
+SUBJECT_SET_SNAPSHOT_REFRESH_TIMEOUT = int(os.environ.get('SUBJECT_SET_SNAPSHOT_REFRESH_TIMEOUT', 10 * 60))
+
+# Rows fetched per round trip when streaming export files from the database
+EXPORT_QUERY_CHUNK_SIZE = int(os.environ.get('EXPORT_QUERY_CHUNK_SIZE', 2000))
+
+# Rows buffered in memory for each row group of Parquet export files
+EXPORT_PARQUET_ROW_GROUP_SIZE = int(os.environ.get('EXPORT_PARQUET_ROW_GROUP_SIZE', 100000))
+
+# Subject manifests are streamed to Azure in blocks of AZURE_UPLOAD_BLOCK_SIZE
+# bytes, with up to AZURE_UPLOAD_CONCURRENCY blocks being uploaded at a time.
+AZURE_UPLOAD_BLOCK_SIZE = int(os.environ.get('AZURE_UPLOAD_BLOCK_SIZE', 8 * 1024 * 1024))
+AZURE_UPLOAD_CONCURRENCY = int(os.environ.get('AZURE_UPLOAD_CONCURRENCY', 8))
+
 CAESAR_URL = os.environ.get(
     'CAESAR_URL',
     'https://caesar.zooniverse.org',
 )
 
+# Parsed Caesar subject reductions are cached on disk, keyed by the data
+# request's id and updated_at, up to CAESAR_CACHE_MAX_SIZE bytes (0 disables
+# the cache).
+CAESAR_CACHE_PATH = os.environ.get(
+    'CAESAR_CACHE_PATH',
+    os.path.join(TMP_STORAGE_PATH, 'caesar'),
+)
+CAESAR_CACHE_MAX_SIZE = int(os.environ.get('CAESAR_CACHE_MAX_SIZE', 1024 * 1024 * 1024))
+
 ZOONIVERSE_API_ENDPOINT = os.getenv('ZOONIVERSE_API_ENDPOINT', None)
 
+# Subject sets are enumerated PANOPTES_PAGE_SIZE subjects per API request,
+# with up to PANOPTES_PAGE_CONCURRENCY requests in flight at once
+PANOPTES_PAGE_SIZE = int(os.environ.get('PANOPTES_PAGE_SIZE', 100))
+PANOPTES_PAGE_CONCURRENCY = int(os.environ.get('PANOPTES_PAGE_CONCURRENCY', 8))
+
 # Camera Traps ML service settings
 SUBJECT_ASSISTANT_EXTERNAL_URL = os.environ.get('SUBJECT_ASSISTANT_EXTERNAL_URL', 'https://subject-assistant.zooniverse.org/#/tasks/')
 SUBJECT_ASSISTANT_AZURE_ACCOUNT_NAME = os.environ.get('SUBJECT_ASSISTANT_AZURE_ACCOUNT_NAME')
 SUBJECT_ASSISTANT_AZURE_ACCOUNT_KEY = os.environ.get('SUBJECT_ASSISTANT_AZURE_ACCOUNT_KEY')
 SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME = os.environ.get('SUBJECT_ASSISTANT_AZURE_CONTAINER_NAME')
 
+# Shareable links to the subject manifests on Azure (for both ML services)
+# are signed for SUBJECT_ASSISTANT_SAS_EXPIRY_DAYS, and re-signed daily by
+# celery beat once they expire in less than SUBJECT_ASSISTANT_SAS_REFRESH_DAYS
+SUBJECT_ASSISTANT_SAS_EXPIRY_DAYS = int(os.environ.get('SUBJECT_ASSISTANT_SAS_EXPIRY_DAYS', 30))
+SUBJECT_ASSISTANT_SAS_REFRESH_DAYS = int(os.environ.get('SUBJECT_ASSISTANT_SAS_REFRESH_DAYS', 7))
+
+# Subject manifests of more than SUBJECT_ASSISTANT_SHARD_SIZE images are split
+# into shards of that many images (for both ML services), each submitted as
+# its own job. Up to SHARD_CONCURRENCY shards are uploaded or submitted at a
+# time. 0 disables sharding.
+SUBJECT_ASSISTANT_SHARD_SIZE = int(os.environ.get('SUBJECT_ASSISTANT_SHARD_SIZE', 0))
+SUBJECT_ASSISTANT_SHARD_CONCURRENCY = int(os.environ.get('SUBJECT_ASSISTANT_SHARD_CONCURRENCY', 4))
+
 # KaDE ML service settings
 KADE_SUBJECT_ASSISTANT_EXTERNAL_URL = os.environ.get('KADE_SUBJECT_ASSISTANT_EXTERNAL_URL', 'https://subject-assistant.zooniverse.org')
 KADE_SUBJECT_ASSISTANT_AZURE_ACCOUNT_NAME = os.environ.get('KADE_SUBJECT_ASSISTANT_AZURE_ACCOUNT_NAME')
@@ -0,0 +1,57 @@
+import io
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from exports.models import MediaMetadata
+
+
+def copy_subject_ids(cursor, table, subject_ids):
+    cursor.execute(
+        'CREATE TEMPORARY TABLE {} (subject_id integer PRIMARY KEY) '
+        'ON COMMIT DROP'.format(table)
+    )
+    cursor.copy_expert(
+        'COPY {} (subject_id) FROM STDIN'.format(table),
+        io.StringIO(''.join('{}\n'.format(int(i)) for i in subject_ids)),
+    )
+    # give the planner the real row count of the temporary table
+    cursor.execute('ANALYZE {}'.format(table))
+
+
+def iter_subject_media_urls(subject_ids):
+    """Yield the distinct (subject_id, url) of the MediaMetadata of many subjects.
+
+    Rather than sending the subject ids in one huge IN clause, they're
+    COPY'd into a temporary table and joined against, and the results are
+    streamed back through a server-side cursor EXPORT_QUERY_CHUNK_SIZE rows
+    at a time.
+    """
+    if connection.vendor != 'postgresql':
+        yield from MediaMetadata.objects.filter(
+            subject_id__in=list(subject_ids),
+        ).values_list('subject_id', 'url').distinct().iterator(
+            chunk_size=settings.EXPORT_QUERY_CHUNK_SIZE,
+        )
+        return
+
+    table = 'workflow_export_subjects'
+    # the temporary table and server-side cursor only live as long as the
+    # transaction
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            copy_subject_ids(cursor, table, subject_ids)
+
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(
+                'SELECT DISTINCT m.subject_id, m.url FROM {} m '
+                'INNER JOIN {} s ON s.subject_id = m.subject_id'.format(
+                    MediaMetadata._meta.db_table,
+                    table,
+                )
+            )
+            while True:
+                rows = cursor.fetchmany(settings.EXPORT_QUERY_CHUNK_SIZE)
+                if not rows:
+                    break
+                yield from rows
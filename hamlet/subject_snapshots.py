@@ -0,0 +1,375 @@
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from panoptes_client import SubjectSet
+
+from exports.models import SubjectSetSnapshot, SubjectSetSnapshotLocation
+from . import panoptes_subjects
+
+
+# seconds between checks on a snapshot that another task is refreshing
+REFRESH_POLL_INTERVAL = 5
+
+
+class SnapshotRefreshLost(Exception):
+    """Another task has taken over the refresh of a snapshot."""
+
+
+class SnapshotGenerationExpired(Exception):
+    """The snapshot generation being read has been garbage collected."""
+
+
+def is_fresh(snapshot, max_age):
+    return (
+        snapshot.refreshed is not None and
+        snapshot.refreshed >= timezone.now() - timedelta(seconds=max_age)
+    )
+
+
+def visible_locations(snapshot, generation=None):
+    """Return a queryset of the locations in a generation of a snapshot.
+
+    Defaults to the generation the snapshot was loaded at.
+    """
+    if generation is None:
+        generation = snapshot.generation
+    return snapshot.locations.filter(
+        Q(removed_generation__isnull=True) |
+        Q(removed_generation__gt=generation),
+        added_generation__lte=generation,
+    )
+
+
+def is_readable(snapshot_id, generation):
+    """Return whether the locations of a snapshot generation are all still there.
+
+    The locations removed by a generation are kept until the one after it
+    is complete, so that tasks still reading the previous generation can
+    finish.
+    """
+    return SubjectSetSnapshot.objects.filter(
+        pk=snapshot_id,
+        generation__gte=generation,
+        generation__lte=generation + 1,
+    ).exists()
+
+
+def is_current(snapshot, subject_set, max_age):
+    """Return whether a snapshot can be used for a Subject Set as it is now in Panoptes.
+
+    Snapshots are out of date once they're older than max_age, or as soon
+    as the set's subject count differs from theirs, e.g. when subjects have
+    just been added to it.
+    """
+    return (
+        is_fresh(snapshot, max_age) and
+        snapshot.subject_count == subject_set.set_member_subjects_count
+    )
+
+
+def claim_refresh(snapshot, token):
+    """Claim the refresh of a snapshot, unless someone else is refreshing it.
+
+    The claim fails if another refresh has finished since the snapshot was
+    loaded. Refreshes that haven't made progress for
+    SUBJECT_SET_SNAPSHOT_REFRESH_TIMEOUT seconds are taken over.
+    """
+    now = timezone.now()
+    timeout = timedelta(seconds=settings.SUBJECT_SET_SNAPSHOT_REFRESH_TIMEOUT)
+    return SubjectSetSnapshot.objects.filter(
+        Q(refresh_token__isnull=True) |
+        Q(refresh_heartbeat__lt=now - timeout),
+        pk=snapshot.pk,
+        generation=snapshot.generation,
+    ).update(refresh_token=token, refresh_heartbeat=now) == 1
+
+
+def heartbeat(snapshot, token):
+    """Record progress on a claimed refresh, and lock its snapshot.
+
+    Called at the start of each transaction of the refresh, so that a
+    refresh that has been taken over writes nothing more.
+    """
+    if not SubjectSetSnapshot.objects.filter(
+        pk=snapshot.pk,
+        refresh_token=token,
+    ).update(refresh_heartbeat=timezone.now()):
+        raise SnapshotRefreshLost(
+            'Refresh of subject set {} snapshot was taken over'.format(
+                snapshot.subject_set_id,
+            )
+        )
+
+
+def refresh_snapshot_page(snapshot, generation, page):
+    """Write the locations of one page of subjects into a new generation.
+
+    Locations that are new or have changed are added in the new generation,
+    and the ones that have been removed from their subject are marked as
+    removed in it. Rows already written to the new generation, by an earlier
+    attempt at the same refresh, are updated or deleted in place.
+    """
+    latest = {
+        (subject_id, frame_id): (pk, url, added_generation)
+        for pk, subject_id, frame_id, url, added_generation in snapshot.locations.filter(
+            subject_id__in=list(page),
+            removed_generation__isnull=True,
+        ).values_list('id', 'subject_id', 'frame_id', 'url', 'added_generation')
+    }
+
+    created = []
+    changed = []
+    removed_ids = []
+    for subject_id, urls in page.items():
+        for frame_id, url in enumerate(urls):
+            current = latest.pop((subject_id, frame_id), None)
+            if current is not None and current[1] == url:
+                continue
+            if current is not None and current[2] == generation:
+                changed.append(SubjectSetSnapshotLocation(
+                    id=current[0],
+                    url=url,
+                ))
+                continue
+            if current is not None:
+                removed_ids.append(current[0])
+            created.append(SubjectSetSnapshotLocation(
+                snapshot=snapshot,
+                subject_id=subject_id,
+                frame_id=frame_id,
+                url=url,
+                added_generation=generation,
+            ))
+
+    # whatever is left are locations that have been removed from subjects
+    removed_ids.extend(pk for pk, _, _ in latest.values())
+    remove_locations(snapshot, generation, removed_ids)
+    SubjectSetSnapshotLocation.objects.bulk_update(changed, ['url'])
+    SubjectSetSnapshotLocation.objects.bulk_create(created)
+
+
+def remove_locations(snapshot, generation, location_ids):
+    """Remove locations as of a new generation.
+
+    Locations added in the new generation itself are deleted, since no
+    complete generation includes them.
+    """
+    locations = snapshot.locations.filter(pk__in=location_ids)
+    locations.filter(added_generation=generation).delete()
+    locations.update(removed_generation=generation)
+
+
+def refresh_snapshot(panoptes, snapshot, subject_set, token, on_page=None):
+    """Bring a snapshot up to date with its Subject Set in Panoptes.
+
+    The subject set is enumerated once into the next generation of the
+    snapshot, and each page of subjects is compared with the snapshot's
+    latest rows for the same subjects, so only new, changed and removed
+    locations are written. Each page is committed in its own transaction,
+    and then passed to on_page, if given, as a list of (subject_id,
+    frame_id, url). The new generation becomes the snapshot's complete
+    generation once every page is written.
+    """
+    refreshed = timezone.now()
+    generation = snapshot.generation + 1
+    links = panoptes_subjects.resolve_links(subject_set, 'project')
+
+    subject_ids = set()
+    location_count = 0
+    for subjects in panoptes_subjects.iter_subject_pages(
+        panoptes,
+        snapshot.subject_set_id,
+    ):
+        page = {}
+        for subject in subjects:
+            subject_id = int(subject['id'])
+            # subjects can move between pages while they're being enumerated
+            if subject_id in subject_ids:
+                continue
+            subject_ids.add(subject_id)
+            page[subject_id] = panoptes_subjects.location_urls(subject)
+            location_count += len(page[subject_id])
+
+        with transaction.atomic():
+            heartbeat(snapshot, token)
+            refresh_snapshot_page(snapshot, generation, page)
+
+        if on_page and page:
+            on_page([
+                (subject_id, frame_id, url)
+                for subject_id, urls in page.items()
+                for frame_id, url in enumerate(urls)
+            ])
+
+    # remove the subjects that have been removed from the subject set
+    removed_subject_ids = [
+        subject_id
+        for subject_id in snapshot.locations.filter(
+            removed_generation__isnull=True,
+        ).values_list('subject_id', flat=True).distinct()
+        if subject_id not in subject_ids
+    ]
+    batch_size = settings.EXPORT_QUERY_CHUNK_SIZE
+    for i in range(0, len(removed_subject_ids), batch_size):
+        with transaction.atomic():
+            heartbeat(snapshot, token)
+            remove_locations(snapshot, generation, snapshot.locations.filter(
+                subject_id__in=removed_subject_ids[i:i + batch_size],
+                removed_generation__isnull=True,
+            ).values_list('id', flat=True))
+
+    with transaction.atomic():
+        heartbeat(snapshot, token)
+        snapshot.generation = generation
+        snapshot.project_id = int(links['project'])
+        snapshot.refreshed = refreshed
+        snapshot.subject_count = len(subject_ids)
+        snapshot.location_count = location_count
+        snapshot.refresh_token = None
+        snapshot.refresh_heartbeat = None
+        snapshot.save()
+
+    # nothing can be reading the generations before the previous one now
+    snapshot.locations.filter(
+        removed_generation__lte=generation - 1,
+    ).delete()
+
+
+def stream_fresh_snapshot(panoptes, subject_set_id, on_page=None, max_age=None):
+    """Return the snapshot of a Subject Set, refreshing it if it's out of date.
+
+    The subject set is always looked up in Panoptes first, as the client's
+    user, so that they can only export sets they have access to. Snapshots
+    that aren't current (see is_current) are refreshed from Panoptes, and
+    each page of the refresh is passed to on_page as soon as it's committed.
+    Only one task refreshes a snapshot at a time, and the others wait for it
+    to finish rather than read an out of date generation.
+
+    Returns the snapshot, loaded at the generation to read, and whether its
+    locations were passed to on_page.
+    """
+    if max_age is None:
+        max_age = settings.SUBJECT_SET_SNAPSHOT_MAX_AGE
+
+    subject_set = SubjectSet.find(subject_set_id)
+    snapshot, _ = SubjectSetSnapshot.objects.get_or_create(
+        subject_set_id=subject_set_id,
+    )
+    token = uuid.uuid4()
+    while True:
+        if is_current(snapshot, subject_set, max_age):
+            return snapshot, False
+        if claim_refresh(snapshot, token):
+            break
+        time.sleep(REFRESH_POLL_INTERVAL)
+        snapshot.refresh_from_db()
+
+    snapshot.refresh_from_db()
+    try:
+        refresh_snapshot(panoptes, snapshot, subject_set, token, on_page=on_page)
+    except:
+        SubjectSetSnapshot.objects.filter(
+            pk=snapshot.pk,
+            refresh_token=token,
+        ).update(refresh_token=None, refresh_heartbeat=None)
+        raise
+    return snapshot, on_page is not None
+
+
+def fresh_snapshot(panoptes, subject_set_id, max_age=None):
+    """Return the snapshot of a Subject Set, refreshing it if it's out of date."""
+    snapshot, _ = stream_fresh_snapshot(panoptes, subject_set_id, max_age=max_age)
+    return snapshot
+
+
+def pinned_snapshot(subject_set_id, generation):
+    """Return the snapshot of a Subject Set loaded at an earlier generation.
+
+    Returns None if that generation is no longer readable.
+    """
+    snapshot = SubjectSetSnapshot.objects.get(subject_set_id=subject_set_id)
+    if not is_readable(snapshot.pk, generation):
+        return None
+    snapshot.generation = generation
+    return snapshot
+
+
+def location_keys_after(locations, subject_id, frame_id):
+    return locations.filter(
+        Q(subject_id__gt=subject_id) |
+        Q(subject_id=subject_id, frame_id__gt=frame_id)
+    )
+
+
+def iter_location_pages(snapshot, after=None, through=None):
+    """Yield the (subject_id, frame_id, url) of a snapshot's locations in pages.
+
+    Pages are lists of EXPORT_QUERY_CHUNK_SIZE locations of the generation
+    the snapshot was loaded at, in order of subject and frame, from after
+    the (subject_id, frame_id) given up to and including the one given as
+    through. Each page is fetched with its own query, and
+    SnapshotGenerationExpired is raised if the generation stops being
+    readable meanwhile.
+    """
+    page_size = settings.EXPORT_QUERY_CHUNK_SIZE
+    locations = visible_locations(snapshot).order_by(
+        'subject_id',
+        'frame_id',
+    ).values_list('subject_id', 'frame_id', 'url')
+    if through is not None:
+        subject_id, frame_id = through
+        locations = locations.filter(
+            Q(subject_id__lt=subject_id) |
+            Q(subject_id=subject_id, frame_id__lte=frame_id)
+        )
+
+    if after is None:
+        page = list(locations[:page_size])
+    else:
+        page = list(location_keys_after(locations, *after)[:page_size])
+    while True:
+        # checked after every page, since an expired generation can look
+        # like one that has simply run out of locations
+        if not is_readable(snapshot.pk, snapshot.generation):
+            raise SnapshotGenerationExpired(
+                'Generation {} of subject set {} snapshot has expired'.format(
+                    snapshot.generation,
+                    snapshot.subject_set_id,
+                )
+            )
+        if page:
+            yield page
+        if len(page) < page_size:
+            break
+        subject_id, frame_id, _ = page[-1]
+        # continue from the end of the previous page, rather than an offset
+        page = list(location_keys_after(locations, subject_id, frame_id)[:page_size])
+
+
+def iter_snapshot_pages(snapshot, after=None):
+    """Yield the pages of a snapshot's locations, after the (subject_id, frame_id) given."""
+    return iter_location_pages(snapshot, after=after)
+
+
+def iter_snapshot_locations(snapshot, after=None, through=None):
+    """Yield the (subject_id, frame_id, url) of the locations in a snapshot.
+
+    Only the locations after the (subject_id, frame_id) given, up to and
+    including the one given as through, are yielded.
+    """
+    for page in iter_location_pages(snapshot, after, through):
+        yield from page
+
+
+def location_key_at(snapshot, index):
+    """Return the (subject_id, frame_id) of the index-th location of a snapshot."""
+    return tuple(visible_locations(snapshot).order_by(
+        'subject_id',
+        'frame_id',
+    ).values_list('subject_id', 'frame_id')[index])
@@ -61,6 +61,11 @@ urlpatterns = [
         views.subject_set,
         name='subject_set'
     ),
+    path(
+        'projects/<int:project_id>/subject-sets/<int:subject_set_id>/exports/<int:export_id>/resume/',
+        views.subject_set_resume,
+        name='subject_set_resume'
+    ),
     path(
         'projects/<int:project_id>/workflows/<int:workflow_id>/',
         views.workflow,
@@ -77,6 +82,11 @@ urlpatterns = [
         views.ml_subject_assistant_export,
         name='ml_subject_assistant_export'
     ),
+    path(
+        'subject-assistant/<int:project_id>/subject-sets/<int:subject_set_id>/exports/<int:export_id>/refresh-link/',
+        views.ml_subject_assistant_refresh_url,
+        name='ml_subject_assistant_refresh_url'
+    ),
     # Zoobot ML Subject Assistant Exports
     path(
         'zoobot-subject-assistant/<int:project_id>/',
@@ -88,6 +98,11 @@ urlpatterns = [
         views.zoobot_subject_assistant_export,
         name='zoobot_subject_assistant_export'
     ),
+    path(
+        'zoobot-subject-assistant/<int:project_id>/subject-sets/<int:subject_set_id>/exports/<int:export_id>/refresh-link/',
+        views.zoobot_subject_assistant_refresh_url,
+        name='zoobot_subject_assistant_refresh_url'
+    ),
     path('admin/', admin.site.urls),
     path('accounts/', include('django.contrib.auth.urls')),
 ]
@@ -3,7 +3,7 @@ from datetime import datetime, timedelta
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
-from django.shortcuts import render, redirect
+from django.shortcuts import get_object_or_404, render, redirect
 from django.views.decorators.http import require_POST
 
 from panoptes_client import Panoptes, Project, SubjectSet, Workflow
@@ -12,8 +12,11 @@ from social_django.utils import load_strategy
 
 from exports.forms import WorkflowExportForm
 from exports.models import SubjectSetExport, WorkflowExport, MLSubjectAssistantExport, KadeSubjectAssistantExport
-from .celery import subject_set_export, workflow_export, ml_subject_assistant_export_to_microsoft, zoobot_subject_assistant_export_to_kade
+from .celery import subject_set_export, resume_subject_set_export, workflow_export, ml_subject_assistant_export_to_microsoft, zoobot_subject_assistant_export_to_kade
 from .zooniverse_auth import SocialPanoptes
+from . import export_files
+from . import ms_ml_exports
+from . import kade_ml_exports
 
 
 def social_context(request):
@@ -64,6 +67,7 @@ def project(request, project_id):
             'subject_set_exports': subject_set_exports,
             'workflow_exports': workflow_exports,
             'workflow_export_form': WorkflowExportForm(),
+            'parquet_available': export_files.parquet_available(),
         }
 
         return render(request, 'project.html', context)
@@ -85,6 +89,27 @@ def subject_set(request, subject_set_id, project_id):
     return redirect('project', project_id=project_id)
 
 
+@login_required
+@require_POST
+def subject_set_resume(request, subject_set_id, project_id, export_id):
+    with social_context(request) as p:
+        if not p.collab_for_project(project_id):
+            raise PermissionDenied
+        export = get_object_or_404(
+            SubjectSetExport,
+            pk=export_id,
+            subject_set_id=subject_set_id,
+        )
+        if export.resumable:
+            task_result = resume_subject_set_export.delay(
+                export.id,
+                p.bearer_token,
+            )
+            export.celery_task = task_result.id
+            export.save(update_fields=['celery_task'])
+    return redirect('project', project_id=project_id)
+
+
 @login_required
 @require_POST
 def workflow(request, workflow_id, project_id):
@@ -94,7 +119,10 @@ def workflow(request, workflow_id, project_id):
             if not p.collab_for_project(project_id):
                 raise PermissionDenied
             access_token = p.bearer_token
-            export = WorkflowExport.objects.create(workflow_id=workflow_id)
+            export = WorkflowExport.objects.create(
+                workflow_id=workflow_id,
+                output_format=form.cleaned_data['output_format'],
+            )
             task_result = workflow_export.delay(
                 export.id,
                 p.bearer_token,
@@ -163,6 +191,26 @@ def ml_subject_assistant_export(request, subject_set_id, project_id):
     return redirect('ml_subject_assistant_list', project_id=project_id)
 
 
+@login_required
+@require_POST
+def ml_subject_assistant_refresh_url(request, subject_set_id, project_id, export_id):
+    """Refresh Action: re-signs the shareable Azure URL of an existing export."""
+
+    # Check permissions
+    with social_context(request) as p:
+        if not p.collab_for_project(project_id):
+            raise PermissionDenied
+
+        export = get_object_or_404(
+            MLSubjectAssistantExport,
+            pk=export_id,
+            subject_set_id=subject_set_id,
+            azure_url__isnull=False,
+        )
+        ms_ml_exports.refresh_shareable_url(export)
+    return redirect('ml_subject_assistant_list', project_id=project_id)
+
+
 @login_required()
 def zoobot_subject_assistant_list(request, project_id):
     """List Page: shows all Subject Sets for a specific Project."""
@@ -221,3 +269,23 @@ def zoobot_subject_assistant_export(request, subject_set_id, project_id):
         export.celery_task = task_result.id
         export.save()
     return redirect('zoobot_subject_assistant_list', project_id=project_id)
+
+
+@login_required
+@require_POST
+def zoobot_subject_assistant_refresh_url(request, subject_set_id, project_id, export_id):
+    """Refresh Action: re-signs the shareable Azure URL of an existing export."""
+
+    # Check permissions
+    with social_context(request) as p:
+        if not p.collab_for_project(project_id):
+            raise PermissionDenied
+
+        export = get_object_or_404(
+            KadeSubjectAssistantExport,
+            pk=export_id,
+            subject_set_id=subject_set_id,
+            azure_url__isnull=False,
+        )
+        kade_ml_exports.refresh_shareable_url(export)
+    return redirect('zoobot_subject_assistant_list', project_id=project_id)
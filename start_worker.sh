@@ -4,4 +4,6 @@ echo Removing logs
 rm tmp/*.log
 
 echo Starting Celery
-exec celery -A hamlet worker -l info
+# Pin the number of worker processes, rather than one per node CPU, so their
+# in-memory media ranges stay within the container's memory limit
+exec celery -A hamlet worker -B --schedule tmp/celerybeat-schedule -l info -c ${CELERY_WORKER_CONCURRENCY:-4}